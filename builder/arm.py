@@ -0,0 +1,372 @@
+# ------------------------------------
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+# ------------------------------------
+
+import asyncio
+import http.client
+import json
+import os
+import queue
+import shutil
+import subprocess
+import threading
+import time
+from datetime import datetime
+from urllib.parse import quote, urlencode, urlsplit
+
+import loggers
+
+ARM_ENDPOINT = os.environ.get('AZURE_ARM_ENDPOINT', 'https://management.azure.com')
+ARM_RESOURCE = 'https://management.azure.com/'
+
+RESOURCES_API_VERSION = '2021-04-01'
+GALLERY_API_VERSION = '2022-03-03'
+
+POOL_SIZE = 8
+TIMEOUT = 60
+POLL_INTERVAL = 5
+TOKEN_REFRESH_MARGIN = 300
+
+TERMINAL_STATES = ['succeeded', 'failed', 'canceled']
+
+# options that don't change the response, all other unknown options make the command fall back to the cli
+IGNORED_OPTIONS = ['--only-show-errors', '--no-prompt']
+
+log = loggers.getLogger(__name__)
+
+
+class ArmError(Exception):
+    '''Raised when the ARM REST api returns an error response'''
+
+    def __init__(self, status, message, code=None, retry_after=None):
+        super().__init__(message)
+        self.status = status
+        self.code = code
+        self.retry_after = retry_after
+
+
+def _cli_token():
+    '''Gets a bearer token for the ARM api from the azure cli'''
+    args = [shutil.which('az'), 'account', 'get-access-token', '--resource', ARM_RESOURCE]
+    proc = subprocess.run(args, capture_output=True, check=True, text=True)
+    token = json.loads(proc.stdout)
+
+    if 'expires_on' in token:
+        expires = int(token['expires_on'])
+    else:  # older versions of the cli only return expiresOn in local time
+        expires = datetime.strptime(token['expiresOn'], '%Y-%m-%d %H:%M:%S.%f').timestamp()
+
+    return {
+        'token': token['accessToken'],
+        'expires': expires,
+        'subscription': token.get('subscription'),
+        'tenant': token.get('tenant')
+    }
+
+
+class ArmClient:
+    '''Minimal ARM REST client that reuses pooled keep-alive connections and a single bearer token'''
+
+    def __init__(self, endpoint=None, token_provider=None, pool_size=POOL_SIZE):
+        self.endpoint = (endpoint or ARM_ENDPOINT).rstrip('/')
+        self.pool_size = pool_size
+        self._token_provider = token_provider or _cli_token
+        self._token = None
+        self._token_lock = threading.Lock()
+        self._pools = {}
+        self._pools_lock = threading.Lock()
+
+    def token(self) -> dict:
+        '''Returns the cached bearer token, only requesting a new one when it is about to expire'''
+        with self._token_lock:
+            if self._token is None or self._token['expires'] - TOKEN_REFRESH_MARGIN < time.time():
+                log.info('Getting access token for the ARM api')
+                self._token = self._token_provider()
+            return self._token
+
+    def _pool(self, netloc):
+        with self._pools_lock:
+            if netloc not in self._pools:
+                self._pools[netloc] = queue.LifoQueue(maxsize=self.pool_size)
+            return self._pools[netloc]
+
+    def _connect(self, scheme, netloc):
+        try:
+            return self._pool(netloc).get_nowait()
+        except queue.Empty:
+            if scheme == 'http':  # only used when testing against a local stub server
+                return http.client.HTTPConnection(netloc, timeout=TIMEOUT)
+            return http.client.HTTPSConnection(netloc, timeout=TIMEOUT)
+
+    def _release(self, netloc, conn):
+        try:
+            self._pool(netloc).put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+    def request(self, method, path, params=None, body=None):
+        '''Sends a request to the ARM api and returns the status, headers, and decoded json body'''
+        url = urlsplit(path if path.startswith('http') else self.endpoint + path)
+        target = url.path + (f'?{url.query}' if url.query else '')
+
+        if params:
+            target += ('&' if url.query else '?') + urlencode(params, quote_via=quote)
+
+        headers = {
+            'Authorization': f'Bearer {self.token()["token"]}',
+            'Accept': 'application/json'
+        }
+
+        payload = None
+        if body is not None:
+            payload = json.dumps(body).encode()
+            headers['Content-Type'] = 'application/json'
+
+        for attempt in range(2):
+            conn = self._connect(url.scheme, url.netloc)
+            try:
+                conn.request(method, target, body=payload, headers=headers)
+                response = conn.getresponse()
+                data = response.read()
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                # pooled keep-alive connections may have been closed by the server, retry once on a new one
+                conn.close()
+                if attempt:
+                    raise
+                continue
+
+            if response.will_close:
+                conn.close()
+            else:
+                self._release(url.netloc, conn)
+
+            resource = json.loads(data) if data else None
+            return response.status, response.headers, resource
+
+    def _check(self, status, headers, resource):
+        if status < 400:
+            return resource
+
+        error = resource.get('error', {}) if isinstance(resource, dict) else {}
+        retry_after = headers.get('Retry-After')
+        raise ArmError(status, f'({error.get("code", status)}) {error.get("message", resource)}',
+                       code=error.get('code'), retry_after=int(retry_after) if retry_after and retry_after.isdigit() else None)
+
+    def get(self, path, api_version):
+        '''Gets a resource, returns None if the resource does not exist'''
+        status, headers, resource = self.request('GET', path, {'api-version': api_version})
+        return None if status == 404 else self._check(status, headers, resource)
+
+    def list(self, path, api_version, params=None) -> list:
+        '''Gets all the pages of a collection'''
+        items = []
+        status, headers, page = self.request('GET', path, dict(params or {}, **{'api-version': api_version}))
+        page = self._check(status, headers, page)
+
+        while page:
+            items.extend(page.get('value', []))
+            next_link = page.get('nextLink')
+            page = self._check(*self.request('GET', next_link)) if next_link else None
+
+        return items
+
+    def put(self, path, api_version, body, wait=True):
+        '''Creates or updates a resource, waiting for the long running operation to finish'''
+        status, headers, resource = self.request('PUT', path, {'api-version': api_version}, body)
+        resource = self._check(status, headers, resource)
+
+        if not wait:
+            return resource
+
+        operation = headers.get('Azure-AsyncOperation')
+
+        while operation:
+            time.sleep(int(headers.get('Retry-After', POLL_INTERVAL)))
+            status, headers, result = self.request('GET', operation)
+            result = self._check(status, headers, result)
+            state = result.get('status', '').lower()
+            if state in TERMINAL_STATES:
+                if state != 'succeeded':
+                    error = result.get('error', {})
+                    raise ArmError(status, f'({error.get("code", state)}) {error.get("message", result)}', code=error.get('code'))
+                return self.get(path, api_version)
+
+        state = (resource or {}).get('properties', {}).get('provisioningState', 'succeeded').lower()
+
+        while state not in TERMINAL_STATES:
+            time.sleep(POLL_INTERVAL)
+            resource = self.get(path, api_version)
+            state = resource.get('properties', {}).get('provisioningState', 'succeeded').lower()
+
+        if state != 'succeeded':
+            raise ArmError(status, f'Provisioning of {path} finished with state {state}')
+
+        return resource
+
+
+def _parse_args(args):
+    '''Splits az cli args into the command (ex. sig image-definition show) and a dict of options'''
+    verbs = []
+    opts = {}
+
+    i = 0
+    while i < len(args) and not args[i].startswith('-'):
+        verbs.append(args[i])
+        i += 1
+
+    while i < len(args):
+        if i + 1 < len(args) and not args[i + 1].startswith('-'):
+            opts[args[i]] = args[i + 1]
+            i += 2
+        else:  # flag without a value
+            opts[args[i]] = True
+            i += 1
+
+    return ' '.join(verbs), opts
+
+
+def _subscription(client, opts):
+    return opts.get('--subscription') or client.token()['subscription']
+
+
+def _group_path(client, opts, group=None):
+    return f'/subscriptions/{_subscription(client, opts)}/resourcegroups/{group or opts["-g"]}'
+
+
+def _gallery_path(client, opts):
+    return f'{_group_path(client, opts)}/providers/Microsoft.Compute/galleries/{opts["-r"]}'
+
+
+def _account_show(client, opts):
+    token = client.token()
+    return {'id': token['subscription'], 'tenantId': token['tenant']}
+
+
+def _group_create(client, opts):
+    return client.put(_group_path(client, opts, opts['-n']), RESOURCES_API_VERSION, {'location': opts['-l']})
+
+
+def _deployment_group_create(client, opts):
+    with open(opts['-f'], 'r') as f:
+        template = json.load(f)
+
+    with open(opts['-p'].lstrip('@'), 'r') as f:
+        parameters = json.load(f)['parameters']
+
+    path = f'{_group_path(client, opts)}/providers/Microsoft.Resources/deployments/{opts["-n"]}'
+    body = {'properties': {'mode': 'Incremental', 'template': template, 'parameters': parameters}}
+
+    return client.put(path, RESOURCES_API_VERSION, body, wait='--no-wait' not in opts)
+
+
+def _img_def_show(client, opts):
+    return client.get(f'{_gallery_path(client, opts)}/images/{opts["-i"]}', GALLERY_API_VERSION)
+
+
+def _img_def_list(client, opts):
+    return client.list(f'{_gallery_path(client, opts)}/images', GALLERY_API_VERSION)
+
+
+def _img_def_create(client, opts):
+    location = opts.get('-l')
+
+    if not location:  # the cli defaults to the location of the gallery
+        location = client.get(_gallery_path(client, opts), GALLERY_API_VERSION)['location']
+
+    features = [{'name': k, 'value': v} for k, v in (f.split('=') for f in opts.get('--features', '').split() if '=' in f)]
+
+    body = {
+        'location': location,
+        'properties': {
+            'osType': opts['--os-type'].capitalize(),
+            'osState': 'Generalized',
+            'hyperVGeneration': opts.get('--hyper-v-generation', 'V1'),
+            'description': opts.get('--description'),
+            'identifier': {
+                'publisher': opts['-p'],
+                'offer': opts['-f'],
+                'sku': opts['-s']
+            },
+            'features': features or None
+        }
+    }
+
+    return client.put(f'{_gallery_path(client, opts)}/images/{opts["-i"]}', GALLERY_API_VERSION, body)
+
+
+def _img_ver_show(client, opts):
+    return client.get(f'{_gallery_path(client, opts)}/images/{opts["-i"]}/versions/{opts["-e"]}', GALLERY_API_VERSION)
+
+
+def _resource_list(client, opts):
+    return client.list(f'{_group_path(client, opts)}/resources', RESOURCES_API_VERSION,
+                       {'$filter': f'resourceType eq \'{opts["--resource-type"]}\''})
+
+
+OPERATIONS = {
+    'account show': (_account_show, []),
+    'group create': (_group_create, ['-n', '-l', '--subscription']),
+    'deployment group create': (_deployment_group_create, ['-n', '-g', '-f', '-p', '--no-wait', '--subscription']),
+    'sig image-definition show': (_img_def_show, ['-g', '-r', '-i', '--subscription']),
+    'sig image-definition list': (_img_def_list, ['-g', '-r', '--subscription']),
+    'sig image-definition create': (_img_def_create, ['-g', '-r', '-i', '-p', '-f', '-s', '-l', '--os-type', '--description',
+                                                      '--hyper-v-generation', '--features', '--subscription']),
+    'sig image-version show': (_img_ver_show, ['-g', '-r', '-i', '-e', '--subscription']),
+    'resource list': (_resource_list, ['-g', '--resource-type', '--subscription'])
+}
+
+
+def supports(args) -> bool:
+    '''Returns True if the az cli command (without the az executable) can be sent directly to the ARM api'''
+    command, opts = _parse_args(args)
+
+    if command not in OPERATIONS:
+        return False
+
+    options = OPERATIONS[command][1]
+
+    if any(o not in options and o not in IGNORED_OPTIONS for o in opts):
+        return False
+
+    if command == 'deployment group create' and not opts['-f'].endswith('.json'):
+        return False  # bicep templates have to be transpiled by the cli
+
+    return True
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client() -> ArmClient:
+    '''Returns the shared client so all commands in a run reuse the same connections and token'''
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = ArmClient()
+        return _client
+
+
+def set_client(client):
+    '''Replaces the shared client (ex. with one pointing at a local stub server)'''
+    global _client
+    with _client_lock:
+        _client = client
+
+
+def execute(args):
+    '''Sends a supported az cli command (without the az executable) to the ARM api and returns the json response'''
+    command, opts = _parse_args(args)
+    operation = OPERATIONS[command][0]
+    return operation(get_client(), opts)
+
+
+# ----------------
+# async functions
+# ----------------
+
+
+async def execute_async(args):
+    '''Sends a supported az cli command (without the az executable) to the ARM api and returns the json response'''
+    return await asyncio.to_thread(execute, args)
@@ -4,34 +4,107 @@
 # ------------------------------------
 
 import asyncio
+import copy
+import hashlib
 import json
 import os
+import random
+import re
 import shutil
-import subprocess
-import sys
+import threading
+import time
+from contextlib import asynccontextmanager
 from pathlib import Path
 
+import arm
+import cache
+import locks
 import loggers
 
 IMAGE_PARAMS_FILE = 'image.parameters.json'
+BUILDER_TEMPLATE = Path(__file__).resolve().parent / 'templates' / 'builder.bicep'
 RESOURCE_NOT_FOUND = 'Code: ResourceNotFound'
 DEFAULT_PARAMS = ['name', 'location', 'version', 'tempResourceGroup', 'buildResourceGroup', 'gallery', 'replicaLocations']
 
+# maximum number of az commands running at the same time (overall and per operation class) in cli_async
+MAX_CONCURRENCY = int(os.environ.get('AZURE_BUILDER_MAX_CONCURRENCY', 8))
+CLASS_CONCURRENCY = {'read': 8, 'write': 4, 'deploy': 4}
+
+# seconds between attempts to acquire a concurrency slot or lock shared across threads
+SLOT_POLL_INTERVAL = 0.05
+
+# throttled and transient az command failures are retried with exponential backoff and jitter
+MAX_RETRIES = 5
+RETRY_BASE_DELAY = 2
+RETRY_MAX_DELAY = 60
+THROTTLED_ERRORS = ['toomanyrequests', 'throttl', 'status code: 429', '(429)']
+TRANSIENT_ERRORS = ['internalservererror', 'serviceunavailable', 'gatewaytimeout', 'badgateway', 'retryableerror',
+                    'connection aborted', 'connection reset', 'timed out', 'temporary failure in name resolution']
+
+# builder status polling interval, grows while nothing changes and resets when a state changes
+POLL_INTERVAL = 10
+POLL_MAX_INTERVAL = 60
+DEPLOYMENT_TERMINAL_STATES = ['Succeeded', 'Failed', 'Canceled']
+CONTAINER_TERMINAL_STATES = ['Succeeded', 'Failed']
+
+# instance states of a builder container group once the build has finished and its packer vm is gone
+BUILDER_FINISHED_STATES = ['Succeeded', 'Failed', 'Stopped']
+
+CONTAINER_USAGE_API_VERSION = '2023-05-01'
+
+# image version provisioning and replication states once an update to its target regions has finished
+VERSION_TERMINAL_STATES = ['Succeeded', 'Failed']
+REPLICATION_TERMINAL_STATES = ['Completed', 'Failed']
+
 log = loggers.getLogger(__name__)
 
+# az commands are run with the azure cli (cli) by default. when set to rest, supported
+# commands are sent directly to the ARM api and all other commands fall back to the cli
+backend = os.environ.get('AZURE_BUILDER_BACKEND', 'cli')
+
 
-def error_exit(message):
-    log.error(message)
-    sys.exit(message)
+class AzCliError(RuntimeError):
+    '''An az command failed. Raised instead of exiting so a failure only fails the build that ran the command'''
 
 
 def _group_create_cmd(group_name, image):
     return ['group', 'create', '-n', group_name, '-l', image['location'], '--subscription', image['subscription']]
 
 
-def _deployment_group_create_cmd(group_name, template_file, params_file, image):
-    return ['deployment', 'group', 'create', '-n', image['name'], '-g', group_name, '-f', template_file,
+def _group_show_cmd(group_name, subscription):
+    return ['group', 'show', '--only-show-errors', '-n', group_name, '--subscription', subscription]
+
+
+def _deployment_group_create_cmd(group_name, template_file, params_file, image, no_wait=False):
+    args = ['deployment', 'group', 'create', '-n', image['name'], '-g', group_name, '-f', template_file,
             '-p', f'@{params_file}', '--no-prompt', '--subscription', image['subscription']]
+    return args + ['--no-wait'] if no_wait else args
+
+
+def _deployment_group_list_cmd(group_name, subscription):
+    return ['deployment', 'group', 'list', '--only-show-errors', '-g', group_name, '--subscription', subscription]
+
+
+def _container_list_cmd(group_name, subscription):
+    return ['container', 'list', '--only-show-errors', '-g', group_name, '--subscription', subscription]
+
+
+def _container_show_cmd(group_name, name, subscription):
+    return ['container', 'show', '--only-show-errors', '-g', group_name, '-n', name, '--subscription', subscription]
+
+
+def _vm_usage_cmd(location, subscription):
+    return ['vm', 'list-usage', '--only-show-errors', '-l', location, '--subscription', subscription]
+
+
+def _container_usage_cmd(location, subscription):
+    # the azure cli doesn't have a command for container instance quotas
+    return ['rest', '--only-show-errors', '--method', 'get', '--url',
+            f'/subscriptions/{subscription}/providers/Microsoft.ContainerInstance/locations/{location}/usages?api-version={CONTAINER_USAGE_API_VERSION}']
+
+
+def _bicep_build_cmd(bicep_file, outfile):
+    return ['bicep', 'build', '--only-show-errors', '-f', str(bicep_file), '--outfile', str(outfile)]
 
 
 def _img_def_show_cmd(image):
@@ -44,6 +117,39 @@ def _img_ver_show_cmd(image):
             '-r', image['gallery']['name'], '-i', image['name'], '-e', image['version'], '--subscription', image['gallery']['subscription']]
 
 
+def _img_def_list_cmd(gallery):
+    return ['sig', 'image-definition', 'list', '--only-show-errors', '-g', gallery['resourceGroup'],
+            '-r', gallery['name'], '--subscription', gallery['subscription']]
+
+
+def _img_ver_list_cmd(gallery):
+    # sig image-version list only works for a single image definition, so we list the
+    # version resources for the whole resource group and filter them by gallery name
+    return ['resource', 'list', '--only-show-errors', '-g', gallery['resourceGroup'],
+            '--resource-type', 'Microsoft.Compute/galleries/images/versions', '--subscription', gallery['subscription']]
+
+
+def _img_ver_replication_show_cmd(image):
+    return _img_ver_show_cmd(image) + ['--expand', 'ReplicationStatus']
+
+
+def _img_ver_replicate_cmd(image, regions):
+    return ['sig', 'image-version', 'update', '--only-show-errors', '-g', image['gallery']['resourceGroup'],
+            '-r', image['gallery']['name'], '-i', image['name'], '-e', image['version'],
+            '--subscription', image['gallery']['subscription'], '--no-wait', '--target-regions'] + regions
+
+
+def _img_def_ver_list_cmd(gallery, definition):
+    return ['sig', 'image-version', 'list', '--only-show-errors', '-g', gallery['resourceGroup'],
+            '-r', gallery['name'], '-i', definition, '--subscription', gallery['subscription']]
+
+
+def _img_ver_tag_cmd(image, tags):
+    return ['sig', 'image-version', 'update', '--only-show-errors', '-g', image['gallery']['resourceGroup'],
+            '-r', image['gallery']['name'], '-i', image['name'], '-e', image['version'],
+            '--subscription', image['gallery']['subscription']] + [a for k, v in tags.items() for a in ['--set', f'tags.{k}={v}']]
+
+
 def _img_def_create_cmd(image):
     return ['sig', 'image-definition', 'create', '--only-show-errors', '-g', image['gallery']['resourceGroup'],
             '-r', image['gallery']['name'], '-i', image['name'], '-p', image['publisher'], '-f', image['offer'],
@@ -71,74 +177,173 @@ def _parse_command(command):
     return args
 
 
-def cli(command, log_command=True):
-    '''Runs an azure cli command and returns the json response'''
-    args = _parse_command(command)
+def set_backend(name):
+    '''Sets the backend used to run az commands (cli or rest)'''
+    global backend
+    if name not in ['cli', 'rest']:
+        raise ValueError(f'az backend must be cli or rest, not {name}')
+    backend = name
 
-    try:
-        if log_command:
-            log.info(f'Running az cli command: {" ".join(args)}')
 
-        proc = subprocess.run(args, capture_output=True, check=True, text=True)
+def _use_rest(args):
+    return backend == 'rest' and arm.supports(args[1:])
 
-        if proc.returncode == 0 and not proc.stdout:
-            return None
-        for line in proc.stdout.splitlines():
+
+def _log_resource(resource, log_output):
+    if log_output and resource:
+        for line in json.dumps(resource, indent=2).splitlines():
             log.info(line)
 
-        resource = json.loads(proc.stdout)
-        return resource
 
-    except subprocess.CalledProcessError as e:
+# time spent waiting for a concurrency slot or retry backoff vs executing az commands
+stats = {'commands': 0, 'retries': 0, 'wait': 0.0, 'backoff': 0.0, 'execute': 0.0}
+_stats_lock = threading.Lock()
 
-        if e.stderr and RESOURCE_NOT_FOUND in e.stderr:
-            return None
 
-        error_exit(e.stderr if e.stderr else 'azure cli command failed')
+def _count(**values):
+    with _stats_lock:
+        for k, v in values.items():
+            stats[k] += v
 
-    except json.decoder.JSONDecodeError:
-        error_exit('{}: {}'.format('Could not decode response json', proc.stderr if proc.stderr else proc.stdout if proc.stdout else proc))
 
+def log_stats():
+    '''Logs the number of az commands and the time spent waiting vs executing them'''
+    log.info(f'az commands: {stats["commands"]} (retries: {stats["retries"]}) '
+             f'executing: {stats["execute"]:.1f}s waiting: {stats["wait"]:.1f}s backoff: {stats["backoff"]:.1f}s')
 
-def get_sub():
-    '''Returns the current subscription id from the azure cli'''
-    sub = cli('az account show')
-    return sub['id']
 
+async def _acquire(lock):
+    '''Acquires a threading lock or semaphore without blocking the event loop'''
+    while not lock.acquire(blocking=False):
+        await asyncio.sleep(SLOT_POLL_INTERVAL)
 
-def ensure_image_def_version(image):
-    '''Ensures that the image definition exists and the version does not exist in the gallery'''
-    image_name = image['name']
-    image_version = image['version']
 
-    build = False
+# the slots are threading semaphores so the limits apply across the event loops of every thread
+_slots = {}
 
-    log.info(f'Validating image definition and version for {image_name}')
-    log.info(f'Checking if image definition exists for {image_name}')
-    imgdef = cli(_img_def_show_cmd(image))
 
-    if imgdef:  # image definition exists, check if the version already exists
+def set_limits(total=None, **classes):
+    '''Sets the maximum number of concurrent az commands overall and per operation class (read, write, deploy)'''
+    global MAX_CONCURRENCY
+    for c in classes:
+        if c not in CLASS_CONCURRENCY:
+            raise ValueError(f'az operation class must be one of {", ".join(CLASS_CONCURRENCY)}, not {c}')
+    if total:
+        MAX_CONCURRENCY = total
+    CLASS_CONCURRENCY.update({c: v for c, v in classes.items() if v})
+    _slots.clear()
+    _slots.update({c: threading.Semaphore(v) for c, v in CLASS_CONCURRENCY.items()})
+    _slots['total'] = threading.Semaphore(MAX_CONCURRENCY)
 
-        log.info(f'Found existing image definition for {image_name}')
-        log.info(f'Checking if image version {image_version} exists for {image_name}')
-        imgver = cli(_img_ver_show_cmd(image))
 
-        if imgver:
-            log.info(f'Found existing image version {image_version} for {image_name}')
-            log.warning(f'{image_name} was not built because version {image_version} already exists. Please update the version number or delete the existing image version and try again.')
-        else:  # image version does not exist, add it to the list of images to create
-            log.info(f'Image version {image_version} does not exist for {image_name}')
-            build = True
+set_limits()
 
-    else:  # image definition does not exist, create it and skip the version check
 
-        log.info(f'Image definition does not exist for {image_name}')
-        log.info(f'Creating image definition for {image_name}')
-        imgdef = cli(_img_def_create_cmd(image))
+def _operation_class(args):
+    if args[1:4] == ['deployment', 'group', 'create']:
+        return 'deploy'
+    return 'read' if cache.read_only(args[1:]) else 'write'
 
-        build = True
 
-    return build, imgdef
+@asynccontextmanager
+async def _limit(args):
+    '''Acquires a concurrency slot for the command's operation class and the overall limit'''
+    start = time.monotonic()
+    operation_slot = _slots[_operation_class(args)]
+    total_slot = _slots['total']
+
+    await _acquire(operation_slot)
+    try:
+        await _acquire(total_slot)
+        try:
+            acquired = time.monotonic()
+            try:
+                yield
+            finally:
+                _count(commands=1, wait=acquired - start, execute=time.monotonic() - acquired)
+        finally:
+            total_slot.release()
+    finally:
+        operation_slot.release()
+
+
+class _RetryableError(Exception):
+
+    def __init__(self, kind, message, retry_after=None):
+        super().__init__(message)
+        self.kind = kind
+        self.retry_after = retry_after
+
+
+def _classify_error(message):
+    '''Returns throttled or transient if the error message indicates the command can be retried, otherwise None'''
+    message = message.lower()
+    if any(e in message for e in THROTTLED_ERRORS):
+        return 'throttled'
+    if any(e in message for e in TRANSIENT_ERRORS):
+        return 'transient'
+    return None
+
+
+def _retry_after(message):
+    match = re.search(r'retry[- ]after\D{0,16}(\d+)', message, re.IGNORECASE)
+    return int(match.group(1)) if match else None
+
+
+def _retry_delay(attempt, retry_after=None):
+    delay = random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))  # full jitter
+    return max(delay, retry_after) if retry_after else delay
+
+
+def _gallery_key(gallery):
+    return (gallery['subscription'].lower(), gallery['resourceGroup'].lower(), gallery['name'].lower())
+
+
+def _inventory_key(definition, version=None):
+    return (definition.lower(), version.lower() if version else None)
+
+
+def _index_inventory(gallery, imgdefs, imgvers):
+    '''Builds an index of the gallery's image definitions and versions keyed by (definition, version)'''
+    inventory = {}
+
+    for imgdef in imgdefs or []:
+        inventory[_inventory_key(imgdef['name'])] = imgdef
+
+    for imgver in imgvers or []:
+        # version resource names are in the form gallery/definition/version
+        parts = imgver['name'].split('/')
+        if len(parts) == 3 and parts[0].lower() == gallery['name'].lower():
+            inventory[_inventory_key(parts[1], parts[2])] = imgver
+
+    log.info(f'Found {len([k for k in inventory if k[1] is None])} image definitions and '
+             f'{len([k for k in inventory if k[1] is not None])} image versions in gallery {gallery["name"]}')
+
+    return inventory
+
+
+def inventory_lookup(inventory, definition, version=None):
+    '''Returns the image definition (or version if specified) from a gallery inventory or None if it does not exist'''
+    return inventory.get(_inventory_key(definition, version))
+
+
+def _version_key(version):
+    return tuple(int(p) if p.isdigit() else 0 for p in version.split('.'))
+
+
+def latest_image_version(inventory, definition):
+    '''Returns the (version, resource) of the highest image version of a definition in a gallery inventory or (None, None)'''
+    versions = [(k[1], v) for k, v in inventory.items() if k[0] == definition.lower() and k[1] is not None]
+    return max(versions, key=lambda v: _version_key(v[0])) if versions else (None, None)
+
+
+def next_image_version(latest, version):
+    '''Returns version if it is newer than latest, otherwise latest with its last (patch) number incremented'''
+    if _version_key(version) > _version_key(latest):
+        return version
+    parts = latest.split('.')
+    parts[-1] = str(int(parts[-1]) + 1)
+    return '.'.join(parts)
 
 
 def save_params_file(image, params, filename):
@@ -166,19 +371,94 @@ def save_params_file(image, params, filename):
     return os.path.join(image['path'], filename)
 
 
-def deploy_builder(image, params_file):
-    '''Deploys the builder resources to kick off the image build'''
-    bicep_file = os.path.join(Path(__file__).resolve().parent, 'templates', 'builder.bicep')
+def _compiled_template(bicep_file):
+    '''Returns the path of the compiled ARM json template for a bicep file, keyed by the hash of its content'''
+    with open(bicep_file, 'rb') as f:
+        digest = hashlib.sha256(f.read()).hexdigest()[:16]
+    return cache.storage / 'cache' / 'bicep' / f'{Path(bicep_file).stem}.{digest}.json'
 
+
+def _builder_group(image):
     if 'tempResourceGroup' in image and image['tempResourceGroup']:
-        group_name = image['tempResourceGroup']
-        group = cli(_group_create_cmd(group_name, image))
-    else:
-        group_name = image['buildResourceGroup']
+        return image['tempResourceGroup']
+    return image['buildResourceGroup']
 
-    dep = cli(_deployment_group_create_cmd(group_name, bicep_file, params_file, image))
 
-    return dep
+def _builder_groups(images):
+    '''Groups the images by the (subscription, resource group) their builder is deployed to'''
+    groups = {}
+    for image in images:
+        groups.setdefault((image['subscription'], _builder_group(image)), []).append(image)
+    return groups
+
+
+def _builder_image(image):
+    '''Gets the name of the image whose builder builds the image, set when several images are built by one builder'''
+    return image.get('builder', image['name'])
+
+
+def _builder_name(image):
+    return _builder_image(image).replace('_', '-').lower()
+
+
+def _builder_status(images, deployments, containers):
+    '''Gets the deployment and container group state for each image from the resources listed in its resource group'''
+    deployments = {d['name'].lower(): d for d in deployments or []}
+    containers = {c['name'].lower(): c for c in containers or []}
+
+    status = {}
+    for image in images:
+        dep = deployments.get(_builder_image(image).lower(), {})
+        group = containers.get(_builder_name(image), {})
+        status[image['name']] = {
+            'deployment': dep.get('properties', dep).get('provisioningState', 'Pending'),
+            'container': group.get('provisioningState', 'Pending'),
+            'instance': (group.get('instanceView') or {}).get('state', '')
+        }
+    return status
+
+
+def _builders_done(status):
+    return all(s['deployment'] in DEPLOYMENT_TERMINAL_STATES and
+               (s['deployment'] != 'Succeeded' or s['container'] in CONTAINER_TERMINAL_STATES) for s in status.values())
+
+
+def _log_status_table(status):
+    width = max([len(n) for n in status] + [5])
+    log.info(f'{"image":<{width}}  {"deployment":<12}  {"container":<12}  state')
+    for name, s in sorted(status.items()):
+        log.info(f'{name:<{width}}  {s["deployment"]:<12}  {s["container"]:<12}  {s["instance"]}')
+
+
+def _region(name):
+    return name.replace(' ', '').lower()  # target regions are returned with their display names (ex. East US)
+
+
+def _replication_status(version) -> dict:
+    '''Gets the provisioning and aggregated replication state of an image version and the replication state per region'''
+    replication = (version or {}).get('replicationStatus') or {}
+    return {
+        'version': (version or {}).get('provisioningState', 'Missing'),
+        'replication': replication.get('aggregatedState', 'Unknown'),
+        'regions': {_region(r['region']): r.get('state', 'Unknown') for r in replication.get('summary') or []}
+    }
+
+
+def _replication_done(status):
+    return all(s['version'] in VERSION_TERMINAL_STATES + ['Missing'] and
+               (s['version'] != 'Succeeded' or s['replication'] in REPLICATION_TERMINAL_STATES) for s in status.values())
+
+
+def _log_replication_table(status):
+    width = max([len(n) for n in status] + [5])
+    log.info(f'{"image":<{width}}  {"version":<12}  {"replication":<12}  regions')
+    for name, s in sorted(status.items()):
+        regions = ', '.join(f'{r}: {state}' for r, state in sorted(s['regions'].items()))
+        log.info(f'{name:<{width}}  {s["version"]:<12}  {s["replication"]:<12}  {regions}')
+
+
+def _next_interval(interval, changed):
+    return POLL_INTERVAL if changed else min(interval * 1.5, POLL_MAX_INTERVAL)
 
 
 # ----------------
@@ -186,36 +466,126 @@ def deploy_builder(image, params_file):
 # ----------------
 
 
-async def cli_async(command, log_command=True):
-    '''Runs an azure cli command and returns the json response'''
-    args = _parse_command(command)
+async def _retry_async(args, run):
+    '''Runs an az command within the concurrency limits, retrying throttled and transient failures with backoff'''
+    for attempt in range(MAX_RETRIES + 1):
+        try:
+            async with _limit(args):
+                return await run()
+        except _RetryableError as e:
+            if attempt == MAX_RETRIES:
+                raise AzCliError(f'az command failed after {MAX_RETRIES} retries: {e}') from e
 
+            delay = _retry_delay(attempt, e.retry_after)
+            log.warning(f'az command {e.kind} ({" ".join(args[1:4])}), retrying in {delay:.1f}s (attempt {attempt + 1} of {MAX_RETRIES})')
+
+            _count(retries=1, backoff=delay)
+            await asyncio.sleep(delay)
+
+
+async def _rest_async(args, log_command=True, log_output=True):
+    '''Sends an az command directly to the ARM api and returns the json response'''
     if log_command:
-        log.info(f'Running az cli command: {" ".join(args)}')
+        log.info(f'Sending az command to ARM api: {" ".join(args[1:])}')
+
+    async def _run():
+        try:
+            return await arm.execute_async(args[1:])
+        except arm.ArmError as e:
+            if e.status == 429:
+                raise _RetryableError('throttled', str(e), e.retry_after)
+            if e.status >= 500:
+                raise _RetryableError('transient', str(e), e.retry_after)
+            raise
+        except OSError as e:
+            raise _RetryableError('transient', str(e))
 
     try:
+        resource = await _retry_async(args, _run)
+    except arm.ArmError as e:
+        raise AzCliError(f'ARM api request failed: {e}') from e
+
+    _log_resource(resource, log_output)
+    return resource
+
+
+async def _cli_async(args, log_command=True, log_output=True):
+    '''Runs an azure cli command in a subprocess and returns the json response'''
+    if log_command:
+        log.info(f'Running az cli command: {" ".join(args)}')
+
+    async def _run():
         proc = await asyncio.create_subprocess_exec(*args, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
         stdout, stderr = await proc.communicate()
+        stdout, stderr = stdout.decode(), stderr.decode()
+
+        if proc.returncode != 0 and RESOURCE_NOT_FOUND not in stderr:
+            kind = _classify_error(stderr)
+            if kind:
+                raise _RetryableError(kind, stderr, _retry_after(stderr))
 
-        if stderr and RESOURCE_NOT_FOUND in stderr.decode():
+        return proc.returncode, stdout, stderr
+
+    returncode, stdout, stderr = await _retry_async(args, _run)
+
+    if returncode != 0:
+        if RESOURCE_NOT_FOUND in stderr:
             return None
+        raise AzCliError(stderr if stderr else 'azure cli command failed')
 
-        if proc.returncode != 0:
-            error_exit(stderr.decode() if stderr else 'azure cli command failed')
+    if not stdout:
+        return None
 
-        if stdout:
-            for line in stdout.decode().splitlines():
-                log.info(line)
+    if log_output:
+        for line in stdout.splitlines():
+            log.info(line)
 
-            try:
-                resource = json.loads(stdout)
-                return resource
-            except json.decoder.JSONDecodeError:
-                error_exit('{}: {}'.format('Could not decode response json', stderr.decode() if stderr else stdout if stdout else proc))
+    try:
+        return json.loads(stdout)
+    except json.decoder.JSONDecodeError:
+        raise AzCliError('{}: {}'.format('Could not decode response json', stderr if stderr else stdout))
+
+
+async def _execute_async(args, log_command=True, log_output=True):
+    cached, resource = cache.get(args[1:])
+    if cached:
+        return resource
+
+    cache.invalidate(args[1:])
+
+    if _use_rest(args):
+        resource = await _rest_async(args, log_command, log_output)
+    else:
+        resource = await _cli_async(args, log_command, log_output)
+
+    cache.put(args[1:], resource)
+    return resource
+
+
+# read-only commands that are currently running, keyed by event loop and args
+_in_flight = {}
 
-    except SystemExit as e:
 
-        error_exit(e.code if e.code else 'azure cli command failed')
+async def cli_async(command, log_command=True, log_output=True):
+    '''Runs an azure cli command and returns the json response. Concurrent calls with the same read-only command share one execution'''
+    args = _parse_command(command)
+
+    if not cache.read_only(args[1:]):
+        return await _execute_async(args, log_command, log_output)
+
+    key = (asyncio.get_running_loop(), tuple(args))
+    future = _in_flight.get(key)
+
+    if future is None:
+        future = asyncio.ensure_future(_execute_async(args, log_command, log_output))
+        future.add_done_callback(lambda _: _in_flight.pop(key, None))
+        _in_flight[key] = future
+    elif log_command:
+        log.info(f'Waiting for in-flight az cli command: {" ".join(args)}')
+
+    # shield so a cancelled caller doesn't cancel the command for the other callers
+    resource = await asyncio.shield(future)
+    return copy.deepcopy(resource)
 
 
 async def get_sub_async():
@@ -224,8 +594,31 @@ async def get_sub_async():
     return sub['id']
 
 
-async def ensure_image_def_version_async(image):
-    '''Ensures that the image definition exists and the version does not exist in the gallery'''
+# gallery inventories are fetched once per gallery per process
+_inventories = {}
+_inventories_lock = threading.Lock()
+
+
+async def get_gallery_inventory_async(gallery, refresh=False) -> dict:
+    '''Lists all image definitions and versions in the gallery and returns an index keyed by (definition, version)'''
+    key = _gallery_key(gallery)
+
+    # concurrent callers (on this or other threads) wait for the first one to fetch the inventory
+    await _acquire(_inventories_lock)
+    try:
+        if refresh or key not in _inventories:
+            log.info(f'Getting image definitions and versions for gallery {gallery["name"]}')
+            imgdefs, imgvers = await asyncio.gather(cli_async(_img_def_list_cmd(gallery), log_output=False),
+                                                    cli_async(_img_ver_list_cmd(gallery), log_output=False))
+            _inventories[key] = _index_inventory(gallery, imgdefs, imgvers)
+
+        return _inventories[key]
+    finally:
+        _inventories_lock.release()
+
+
+async def ensure_image_def_version_async(image, inventory=None):
+    '''Ensures that the image definition exists and the version does not exist in the gallery, using the gallery inventory if provided'''
     image_name = image['name']
     image_version = image['version']
 
@@ -233,13 +626,13 @@ async def ensure_image_def_version_async(image):
 
     log.info(f'Validating image definition and version for {image_name}')
     log.info(f'Checking if image definition exists for {image_name}')
-    imgdef = await cli_async(_img_def_show_cmd(image))
+    imgdef = await cli_async(_img_def_show_cmd(image)) if inventory is None else inventory_lookup(inventory, image_name)
 
     if imgdef:  # image definition exists, check if the version already exists
 
         log.info(f'Found existing image definition for {image_name}')
         log.info(f'Checking if image version {image_version} exists for {image_name}')
-        imgver = await cli_async(_img_ver_show_cmd(image))
+        imgver = await cli_async(_img_ver_show_cmd(image)) if inventory is None else inventory_lookup(inventory, image_name, image_version)
 
         if imgver:
             log.info(f'Found existing image version {image_version} for {image_name}')
@@ -254,14 +647,44 @@ async def ensure_image_def_version_async(image):
         log.info(f'Creating image definition for {image_name}')
         imgdef = await cli_async(_img_def_create_cmd(image))
 
+        if inventory is not None and imgdef:
+            inventory[_inventory_key(image_name)] = imgdef
+
         build = True
 
     return build, imgdef
 
 
-async def deploy_builder_async(image, params_file):
-    '''Deploys the builder resources to kick off the image build'''
-    bicep_file = os.path.join(Path(__file__).resolve().parent, 'templates', 'builder.bicep')
+async def get_latest_image_version_async(gallery, definition) -> str:
+    '''Returns the highest successfully published version of an image definition, listed without using the inventory or cache'''
+    versions = await cli_async(_img_def_ver_list_cmd(gallery, definition), log_output=False)
+    versions = [v['name'] for v in versions or [] if v.get('provisioningState', 'Succeeded') == 'Succeeded']
+    return max(versions, key=_version_key) if versions else None
+
+
+async def tag_image_version_async(image, tags):
+    '''Adds tags to the image's version in the gallery'''
+    log.info(f'Tagging image version {image["version"]} for {image["name"]} with {", ".join(tags)}')
+    return await cli_async(_img_ver_tag_cmd(image, tags), log_output=False)
+
+
+async def compile_bicep_async(bicep_file=BUILDER_TEMPLATE) -> str:
+    '''Compiles a bicep file to an ARM json template, reusing a previously compiled template if the bicep file is unchanged'''
+    template_file = _compiled_template(bicep_file)
+
+    if template_file.is_file():
+        log.info(f'Using compiled template {template_file} for {bicep_file}')
+    else:
+        log.info(f'Compiling {bicep_file} to {template_file}')
+        with locks.replacing(template_file) as temp:  # concurrent runs never deploy a partial template
+            await cli_async(_bicep_build_cmd(bicep_file, temp))
+
+    return str(template_file)
+
+
+async def deploy_builder_async(image, params_file, template_file=None, no_wait=False):
+    '''Deploys the builder resources to kick off the image build, optionally returning without waiting for the deployment'''
+    template_file = template_file if template_file else await compile_bicep_async()
 
     if 'tempResourceGroup' in image and image['tempResourceGroup']:
         group_name = image['tempResourceGroup']
@@ -269,6 +692,190 @@ async def deploy_builder_async(image, params_file):
     else:
         group_name = image['buildResourceGroup']
 
-    dep = await cli_async(_deployment_group_create_cmd(group_name, bicep_file, params_file, image))
+    dep = await cli_async(_deployment_group_create_cmd(group_name, template_file, params_file, image, no_wait))
 
     return dep
+
+
+async def wait_for_builders_async(images) -> dict:
+    '''Polls the deployment and container group state of the builders for all images until they're provisioned'''
+    groups = _builder_groups(images)
+    interval = POLL_INTERVAL
+    status = {}
+
+    async def _group_status(subscription, group_name, group_images):
+        deployments, containers = await asyncio.gather(
+            cli_async(_deployment_group_list_cmd(group_name, subscription), log_command=False, log_output=False),
+            cli_async(_container_list_cmd(group_name, subscription), log_command=False, log_output=False))
+        return _builder_status(group_images, deployments, containers)
+
+    while True:
+        current = {}
+        for s in await asyncio.gather(*[_group_status(sub, group, imgs) for (sub, group), imgs in groups.items()]):
+            current.update(s)
+
+        changed = current != status
+        status = current
+
+        if changed:
+            _log_status_table(status)
+
+        if _builders_done(status):
+            return status
+
+        interval = _next_interval(interval, changed)
+        await asyncio.sleep(interval)
+
+
+async def wait_for_builder_async(image) -> str:
+    '''Polls the container group of an image's builder until the build has finished and returns its final state'''
+    subscription, group_name = image['subscription'], _builder_group(image)
+    interval = POLL_INTERVAL
+    state = None
+
+    while True:
+        group = await cli_async(_container_show_cmd(group_name, _builder_name(image), subscription), log_command=False, log_output=False)
+
+        if group is None:  # the container group was deleted or never created
+            return state or 'Missing'
+
+        changed = (group.get('instanceView') or {}).get('state', '') != state
+        state = (group.get('instanceView') or {}).get('state', '')
+
+        if group.get('provisioningState') == 'Failed' or state in BUILDER_FINISHED_STATES:
+            log.info(f'Builder for {image["name"]} finished with state {state or group.get("provisioningState")}')
+            return state or group.get('provisioningState')
+
+        interval = _next_interval(interval, changed)
+        await asyncio.sleep(interval)
+
+
+async def replicate_image_version_async(image) -> list:
+    '''Adds the image's replicaLocations to the target regions of its published version without waiting for the replication'''
+    version = await cli_async(_img_ver_replication_show_cmd(image), log_output=False)
+
+    if version is None:
+        raise AzCliError(f'Image version {image["version"]} for {image["name"]} was not found, can not replicate it')
+
+    current = [_region(r['name']) for r in version.get('publishingProfile', {}).get('targetRegions') or []]
+    regions = current + [r for r in dict.fromkeys(_region(r) for r in image.get('replicaLocations') or []) if r not in current]
+
+    if regions == current:
+        log.info(f'Image version {image["version"]} for {image["name"]} is already replicated to {", ".join(regions)}')
+    else:
+        log.info(f'Replicating image version {image["version"]} for {image["name"]} to {", ".join(regions[len(current):])}')
+        await cli_async(_img_ver_replicate_cmd(image, regions), log_output=False)
+
+    return regions
+
+
+async def wait_for_replication_async(images) -> dict:
+    '''Polls the replication status of the images' published versions until replication to every region has finished'''
+    interval = POLL_INTERVAL
+    status = {}
+
+    while True:
+        versions = await asyncio.gather(*[cli_async(_img_ver_replication_show_cmd(i), log_command=False, log_output=False) for i in images])
+        current = {i['name']: _replication_status(v) for i, v in zip(images, versions)}
+
+        changed = current != status
+        status = current
+
+        if changed:
+            _log_replication_table(status)
+
+        if _replication_done(status):
+            return status
+
+        interval = _next_interval(interval, changed)
+        await asyncio.sleep(interval)
+
+
+async def get_usage_async(location, subscription) -> list:
+    '''Gets the current usage and limits of the compute (vCPU) and container instance quotas in a location'''
+    compute, containers = await asyncio.gather(cli_async(_vm_usage_cmd(location, subscription), log_output=False),
+                                               cli_async(_container_usage_cmd(location, subscription), log_output=False))
+    return (compute or []) + ((containers or {}).get('value') or [])
+
+
+async def get_group_location_async(group_name, subscription) -> str:
+    '''Gets the location of a resource group, or None if it doesn't exist'''
+    group = await cli_async(_group_show_cmd(group_name, subscription), log_output=False)
+    return group['location'] if group else None
+
+
+# ----------------
+# sync functions
+# ----------------
+# thin wrappers that run the async functions to completion so synchronous
+# callers get the same limits, retries, caching and instrumentation
+
+
+def cli(command, log_command=True, log_output=True):
+    '''Runs an azure cli command and returns the json response'''
+    return asyncio.run(cli_async(command, log_command, log_output))
+
+
+def get_sub():
+    '''Returns the current subscription id from the azure cli'''
+    return asyncio.run(get_sub_async())
+
+
+def get_gallery_inventory(gallery, refresh=False) -> dict:
+    '''Lists all image definitions and versions in the gallery and returns an index keyed by (definition, version)'''
+    return asyncio.run(get_gallery_inventory_async(gallery, refresh))
+
+
+def ensure_image_def_version(image, inventory=None):
+    '''Ensures that the image definition exists and the version does not exist in the gallery, using the gallery inventory if provided'''
+    return asyncio.run(ensure_image_def_version_async(image, inventory))
+
+
+def get_latest_image_version(gallery, definition) -> str:
+    '''Returns the highest successfully published version of an image definition, listed without using the inventory or cache'''
+    return asyncio.run(get_latest_image_version_async(gallery, definition))
+
+
+def tag_image_version(image, tags):
+    '''Adds tags to the image's version in the gallery'''
+    return asyncio.run(tag_image_version_async(image, tags))
+
+
+def compile_bicep(bicep_file=BUILDER_TEMPLATE) -> str:
+    '''Compiles a bicep file to an ARM json template, reusing a previously compiled template if the bicep file is unchanged'''
+    return asyncio.run(compile_bicep_async(bicep_file))
+
+
+def deploy_builder(image, params_file, template_file=None, no_wait=False):
+    '''Deploys the builder resources to kick off the image build, optionally returning without waiting for the deployment'''
+    return asyncio.run(deploy_builder_async(image, params_file, template_file, no_wait))
+
+
+def wait_for_builder(image) -> str:
+    '''Polls the container group of an image's builder until the build has finished and returns its final state'''
+    return asyncio.run(wait_for_builder_async(image))
+
+
+def replicate_image_version(image) -> list:
+    '''Adds the image's replicaLocations to the target regions of its published version without waiting for the replication'''
+    return asyncio.run(replicate_image_version_async(image))
+
+
+def wait_for_replication(images) -> dict:
+    '''Polls the replication status of the images' published versions until replication to every region has finished'''
+    return asyncio.run(wait_for_replication_async(images))
+
+
+def get_usage(location, subscription) -> list:
+    '''Gets the current usage and limits of the compute (vCPU) and container instance quotas in a location'''
+    return asyncio.run(get_usage_async(location, subscription))
+
+
+def get_group_location(group_name, subscription) -> str:
+    '''Gets the location of a resource group, or None if it doesn't exist'''
+    return asyncio.run(get_group_location_async(group_name, subscription))
+
+
+def wait_for_builders(images) -> dict:
+    '''Polls the deployment and container group state of the builders for all images until they're provisioned'''
+    return asyncio.run(wait_for_builders_async(images))
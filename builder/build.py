@@ -6,15 +6,22 @@
 import argparse
 import asyncio
 import sys
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone
 
 import azure as az
+import executors
+import history
 import image as img
 import loggers
+import quota
 import repos
 
 BUILDER_PARAMS_FILE = 'builder.parameters.json'
 
+# final states of a build that mean the image wasn't published
+FAILED_STATES = ['Failed', 'Stopped', 'Missing']
+
 log = loggers.getLogger(__name__)
 
 
@@ -23,46 +30,250 @@ def error_exit(message):
     sys.exit(message)
 
 
-def main(gallery, common, names, params, suffix, skip_build=False):
+def _process_image(name, gallery, common, params, suffix, executor, skip_build=False, skip_unchanged=False, auto_version=False, wait=False,
+                   defer_replication=False):
+    '''Resolves an image, saves its builder parameters file, and starts its build, grouping the log output for the image'''
+    with loggers.grouped():
+        try:
+            image = img.get(name, gallery, common, suffix, ensure_azure=True, skip_unchanged=skip_unchanged, auto_version=auto_version)
+
+            if image['build']:
+                params_file = az.save_params_file(image, params, BUILDER_PARAMS_FILE)
+
+                if not skip_build:
+                    image['state'] = executor.run(image, params_file, wait)
+                    if image['state'] in FAILED_STATES:
+                        error_exit(f'Builder for {name} failed')
+
+                    if defer_replication:
+                        image['targetRegions'] = az.replicate_image_version(image)
+
+            return image, None
+
+        except (Exception, SystemExit) as e:  # error_exit raises SystemExit
+            log.error(f'Failed to process image {name}: {e}')
+            return None, str(e) if str(e) else type(e).__name__
+
+
+def _schedule(names, slots, history_files=None) -> list:
+    '''Orders the images longest expected build first when the executor's slots can't run all their builds at the same time and logs the predicted makespan'''
+    if not slots or slots >= len(names):  # no slots when the executor doesn't bound how many builds run at the same time
+        return names
+
+    durations = history.load(history_files)
+    ordered = history.longest_first(names, durations)
+
+    log.info(f'Scheduling {len(names)} images on {slots} slots, longest expected build first:')
+    for n in ordered:
+        log.info(f'  {history.format_duration(history.expected(durations, n)):>8} {n}{"" if n in durations else " (no history)"}')
+
+    log.info(f'Predicted makespan: {history.format_duration(history.makespan(ordered, durations, slots))} '
+             f'(in the original order: {history.format_duration(history.makespan(names, durations, slots))})')
+
+    return ordered
+
+
+def _blocked(wave, bases, failed) -> dict:
+    '''Gets the images in a wave that can't be built because their base image failed in an earlier wave'''
+    blocked = {}
+    for name in wave:
+        if bases.get(name) in failed:
+            log.error(f'Skipping {name} because its base image {bases[name]} failed')
+            blocked[name] = (None, f'base image {bases[name]} failed')
+    return blocked
+
+
+def _log_waves(waves):
+    if len(waves) > 1:
+        log.info(f'Building {len(waves)} waves of images, each wave starts when the base images in the previous wave are published:')
+        for i, wave in enumerate(waves):
+            log.info(f'  wave {i + 1}: {", ".join(wave)}')
+
+
+def _replication_failures(status) -> list:
+    '''Gets the images whose versions failed to replicate to all their target regions'''
+    failed = [n for n, s in status.items() if s['version'] != 'Succeeded' or s['replication'] != 'Completed']
+    for name in failed:
+        log.error(f'Replication of {name} finished with version state {status[name]["version"]} and replication state {status[name]["replication"]}')
+    return failed
+
+
+def _log_summary(results):
+    '''Logs which images were deployed, skipped, or failed'''
+    log.info('Summary:')
+    for name, (image, error) in results.items():
+        if error:
+            log.error(f'  {name}: failed ({error.strip().splitlines()[-1]})')
+        elif image['build']:
+            log.info(f'  {name}: {"built" if image.get("state") == "Succeeded" else "deployed"}')
+        elif image.get('unchanged'):
+            log.info(f'  {name}: skipped (inputs unchanged since version {image["unchanged"]})')
+        else:
+            log.info(f'  {name}: skipped (version {image["version"]} already exists)')
+
+
+def main(gallery, common, names, params, suffix, skip_build=False, no_wait=False, jobs=1, skip_unchanged=False, auto_version=False,
+         history_files=None, executor=None, defer_replication=False):
     if names is None:
-        images = img.all(gallery, common, suffix, ensure_azure=True)
-    else:
-        images = [img.get(n, gallery, common, suffix, ensure_azure=True) for n in names]
+        names = img.image_names()
+
+    executor = executor or executors.AciExecutor(no_wait)
+
+    waves = img.waves(names)
+    bases = img.graph(names)
+    _log_waves(waves)
+
+    # compile the builder template once and deploy the same arm template for every image
+    if not skip_build:
+        executor.prepare()
+
+    results = {}
+
+    for i, wave in enumerate(waves):
+        # builds in all but the last wave are waited for, the next wave starts from the images they publish.
+        # with deferred replication every build is waited for, so its version can be replicated when it's published
+        wait = (i < len(waves) - 1 or defer_replication) and not skip_build
+
+        blocked = _blocked(wave, bases, [n for n, (image, error) in results.items() if error])
+        results.update(blocked)
+
+        # the pool's queue is first in, first out, so builds start in the scheduled order
+        wave = _schedule([n for n in wave if n not in blocked], executor.slots, history_files)
 
-    for image in images:
+        with ThreadPoolExecutor(max_workers=max(jobs, 1)) as pool:
+            futures = {n: pool.submit(_process_image, n, gallery, common, params, suffix, executor, skip_build,
+                                      skip_unchanged, auto_version, wait, defer_replication) for n in wave}
+            results.update({n: f.result() for n, f in futures.items()})
 
-        if image['build']:
-            params_file = az.save_params_file(image, params, BUILDER_PARAMS_FILE)
+    images = [image for image, error in results.values() if image]
 
-            if not skip_build:
-                az.deploy_builder(image, params_file)
+    if not skip_build:
+        executor.finish([i for i in images if i['build']])
+
+    replicated = [i for i in images if i.get('targetRegions')]
+    if replicated:
+        log.info(f'Waiting for {len(replicated)} image versions to replicate')
+        for name in _replication_failures(az.wait_for_replication(replicated)):
+            results[name] = (results[name][0], 'replication failed')
 
     if skip_build:
         log.warning('Skipping build execution because --skip-build was provided')
 
+    _log_summary(results)
+    az.log_stats()
+
+    failed = [n for n, (image, error) in results.items() if error]
+    if failed:
+        error_exit(f'Failed to process {len(failed)} of {len(results)} images: {", ".join(failed)}')
+
 
 # ----------------
 # async functions
 # ----------------
 
 
-async def main_async(gallery, common, names, params, suffix, skip_build=False):
+async def main_async(gallery, common, names, params, suffix, skip_build=False, no_wait=False, skip_unchanged=False, auto_version=False,
+                     history_files=None, admission=None, executor=None, defer_replication=False):
     if names is None:
         names = img.image_names()
 
-    async def _process_image_async(name):
-        image = await img.get_async(name, gallery, common, suffix, ensure_azure=True)
+    executor = executor or executors.AciExecutor(no_wait)
+
+    waves = img.waves(names)
+    bases = img.graph(names)
+    _log_waves(waves)
+
+    # prepare once before the fan-out, so the deployments don't
+    # all transpile (and try to install) bicep at the same time
+    if not skip_build:
+        await executor.prepare_async()
+
+    async def _resolve_image_async(name):
+        try:
+            return name, (await img.get_async(name, gallery, common, suffix, ensure_azure=True, skip_unchanged=skip_unchanged,
+                                              auto_version=auto_version), None)
+        except (Exception, SystemExit) as e:  # error_exit raises SystemExit
+            log.error(f'Failed to process image {name}: {e}')
+            return name, (None, str(e) if str(e) else type(e).__name__)
+
+    async def _process_images_async(group, wait=False):
+        '''Deploys the builder of a group of images, the first image's builder builds every image in the group'''
+        image = group[0]
+        names = [i['name'] for i in group]
+
+        try:
+            if image['build']:
+                builder_params = params if len(group) == 1 else dict(params, images=names, versions=[i['version'] for i in group],
+                                                                     maxBuilds=len(group))
+                params_file = az.save_params_file(image, builder_params, BUILDER_PARAMS_FILE)
+                state = None
+
+                if not skip_build and admission:
+                    # hold the image's quota until its build finishes so queued builds only start when there is room
+                    async with admission.admit(image):
+                        state = await executor.run_async(image, params_file, wait=True)
+                elif not skip_build:
+                    state = await executor.run_async(image, params_file, wait)
+
+                for i in group:
+                    i['state'] = state
+
+                if state in FAILED_STATES:
+                    error_exit(f'Builder for {", ".join(names)} failed')
+
+                # replication starts as soon as the image is published, it doesn't hold the image's quota
+                if defer_replication and state == 'Succeeded':
+                    for i, regions in zip(group, await asyncio.gather(*[az.replicate_image_version_async(i) for i in group])):
+                        i['targetRegions'] = regions
+
+            return {i['name']: (i, None) for i in group}
+
+        except (Exception, SystemExit) as e:  # error_exit raises SystemExit
+            log.error(f'Failed to process {"image" if len(group) == 1 else "images"} {", ".join(names)}: {e}')
+            return {n: (None, str(e) if str(e) else type(e).__name__) for n in names}
+
+    results = {}
 
-        if image['build']:
-            params_file = az.save_params_file(image, params, BUILDER_PARAMS_FILE)
+    for i, wave in enumerate(waves):
+        # builds in all but the last wave are waited for, the next wave starts from the images they publish.
+        # with deferred replication every build is waited for, so its version can be replicated when it's published
+        wait = (i < len(waves) - 1 or defer_replication) and not skip_build
 
-            if not skip_build:
-                await az.deploy_builder_async(image, params_file)
+        blocked = _blocked(wave, bases, [n for n, (image, error) in results.items() if error])
+        results.update(blocked)
 
-        if skip_build:
-            log.warning('Skipping build execution because --skip-build was provided')
+        resolved = dict(await asyncio.gather(*[_resolve_image_async(n) for n in wave if n not in blocked]))
+        results.update({n: (image, error) for n, (image, error) in resolved.items() if error})
+        resolved = {n: image for n, (image, error) in resolved.items() if not error}
 
-    await asyncio.gather(*[_process_image_async(n) for n in names])
+        # the builds are started in the scheduled order and the executor's slots are first in, first out,
+        # so builds that have to wait for a slot start in the scheduled order too
+        ordered = _schedule([n for n, image in resolved.items() if image['build']], executor.slots, history_files)
+        ordered += [n for n in resolved if n not in ordered]
+
+        for processed in await asyncio.gather(*[_process_images_async(g, wait) for g in executor.group([resolved[n] for n in ordered])]):
+            results.update(processed)
+
+    images = [image for image, error in results.values() if image]
+
+    if not skip_build:
+        await executor.finish_async([i for i in images if i['build']])
+
+    replicated = [i for i in images if i.get('targetRegions')]
+    if replicated:
+        log.info(f'Waiting for {len(replicated)} image versions to replicate')
+        for name in _replication_failures(await az.wait_for_replication_async(replicated)):
+            results[name] = (results[name][0], 'replication failed')
+
+    if skip_build:
+        log.warning('Skipping build execution because --skip-build was provided')
+
+    _log_summary(results)
+    az.log_stats()
+
+    failed = [n for n, (image, error) in results.items() if error]
+    if failed:
+        error_exit(f'Failed to process {len(failed)} of {len(results)} images: {", ".join(failed)}')
 
 
 if __name__ == '__main__':
@@ -72,9 +283,22 @@ if __name__ == '__main__':
                                      epilog='example: python3 aci.py --suffix 22 --build')
     parser.add_argument('--images', '-i', nargs='*', help='names of images to build. if not specified all images will be')
     parser.add_argument('--async', '-a', dest='is_async', action='store_true', help='build images asynchronously. because the processes run in parallel, the output is not ordered')
+    parser.add_argument('--jobs', '-j', type=int, default=1, help='number of images to process at the same time when not using --async, and the number of local builder processes with --executor local. output is grouped per image. default: 1')
     parser.add_argument('--changes', '-c', nargs='*', help='paths of the files that changed to determine which images to build. if not specified all images will be built')
     parser.add_argument('--suffix', '-s', help='suffix to append to the resource group name. if not specified, the current time will be used')
     parser.add_argument('--skip-build', action='store_true', help='skip building images with packer')
+    parser.add_argument('--skip-unchanged', action='store_true', help='skip images whose fingerprint (image files, scripts, properties, and builder) matches the latest version in the gallery')
+    parser.add_argument('--auto-version', action='store_true', help='assign the next patch version to images whose fingerprint differs from the latest version in the gallery')
+    parser.add_argument('--no-wait', action='store_true', help='submit all builder deployments without waiting for them, then poll the status of all builders until they are provisioned')
+    parser.add_argument('--max-concurrency', type=int, help='maximum number of az commands to run at the same time when using --async. default: 8')
+    parser.add_argument('--max-deployments', type=int, help='maximum number of builder deployments to run at the same time when using --async. default: 4')
+    parser.add_argument('--history', nargs='*', help='files with past build durations ({"image": seconds} or packer build profiles) used to schedule the longest builds first when --executor local has fewer --jobs than images. has no effect with --executor aci. local builds are recorded automatically')
+    parser.add_argument('--executor', choices=['aci', 'local'], default='aci', help='run each build in an azure container instance or in a local builder.py process (self-hosted runners with packer and the azure cli). default: aci')
+    parser.add_argument('--defer-replication', action='store_true', help='publish image versions only to the build region, then replicate them to their replicaLocations after each build instead of during it')
+    parser.add_argument('--quota', action='store_true', help='when using --async, only start builds while the regional vCPU and container instance quotas have room for them, queueing the rest')
+    parser.add_argument('--images-per-builder', type=int, default=1, help='when using --async, build up to this many images that share a buildResourceGroup in one container instance. a failed build fails every image in its container instance. default: 1')
+    parser.add_argument('--quota-file', help='json file with the quota usage and limits per location to use with --quota instead of querying azure')
+    parser.add_argument('--backend', choices=['cli', 'rest'], default=az.backend, help='run az commands with the azure cli or send supported commands directly to the ARM api. default: cli')
 
     parser.add_argument('--subnet-id', '-sni', help='The resource id of a subnet to use for the container instance. If this is not specified, the container instance will not be created in a virtual network and have a public ip address.')
     parser.add_argument('--storage-account', '-sa', help='The name of an existing storage account to use with the container instance. If not specified, the container instance will not mount a persistant file share.')
@@ -83,6 +307,7 @@ if __name__ == '__main__':
     parser.add_argument('--repository', '-r', required=True, help='The git repository that contains your image.yml and buiild scripts.')
     parser.add_argument('--revision', '-b', help='The git repository revision that contains your image.yml and buiild scripts.')
     parser.add_argument('--token', '-t', help='The PAT token to use when cloning the git repository.')
+    parser.add_argument('--mirror-repository', action='store_true', help='check out only the folders needed for each build from a git mirror on the storage account file share instead of cloning the whole repository. requires --storage-account')
 
     args = parser.parse_args()
 
@@ -106,16 +331,60 @@ if __name__ == '__main__':
     if args.storage_account:
         params['storageAccount'] = args.storage_account
 
+    if args.defer_replication:
+        params['deferReplication'] = True
+
+    if args.mirror_repository:
+        if not args.storage_account:
+            error_exit('--mirror-repository requires --storage-account to keep the mirror on')
+        params['mirrorRepository'] = True
+
+    az.set_backend(args.backend)
+    az.set_limits(args.max_concurrency, deploy=args.max_deployments)
+
     is_async = args.is_async
     skip_build = args.skip_build
+    no_wait = args.no_wait
     names = args.images if args.images else None
 
-    suffix = args.suffix if args.suffix else datetime.now(timezone.utc).strftime('%Y%m%d%H%M')
+    if args.changes:
+        names = img.affected(args.changes, names)
+        if not names:
+            log.warning('No images are affected by the changes provided with --changes, nothing to build')
+            sys.exit(0)
+        log.info(f'Images affected by changes: {", ".join(names)}')
 
-    gallery = img.get_gallery()
-    common = img.get_common()
+    suffix = args.suffix if args.suffix else datetime.now(timezone.utc).strftime('%Y%m%d%H%M')
 
-    if is_async:
-        asyncio.run(main_async(gallery, common, names, params, suffix, skip_build))
-    else:
-        main(gallery, common, names, params, suffix, skip_build)
+    # az failures are raised as exceptions so one image's failure doesn't stop the others, here they end the run
+    try:
+        gallery = img.get_gallery()
+        common = img.get_common()
+
+        admission = None
+        if args.quota or args.quota_file:
+            if not is_async:
+                log.warning('Ignoring --quota because it is only supported with --async')
+            else:
+                admission = quota.Admission(quota.file_source(args.quota_file) if args.quota_file else None)
+
+        if args.images_per_builder > 1 and (not is_async or args.executor == 'local' or admission):
+            log.warning('Ignoring --images-per-builder because it is only supported with --async and --executor aci, without --quota')
+            args.images_per_builder = 1
+
+        if args.history and args.executor != 'local':
+            log.warning('Ignoring --history because builds are only scheduled with --executor local')
+
+        if args.executor == 'local':
+            executor = executors.LocalExecutor(params, args.jobs)
+        else:
+            executor = executors.AciExecutor(no_wait, args.images_per_builder)
+
+        if is_async:
+            asyncio.run(main_async(gallery, common, names, params, suffix, skip_build, no_wait, args.skip_unchanged, args.auto_version, args.history,
+                                   admission, executor, args.defer_replication))
+        else:
+            main(gallery, common, names, params, suffix, skip_build, no_wait, args.jobs, args.skip_unchanged, args.auto_version, args.history,
+                 executor, args.defer_replication)
+    except az.AzCliError as e:
+        error_exit(str(e))
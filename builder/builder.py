@@ -3,20 +3,29 @@
 # Licensed under the MIT License.
 # ------------------------------------
 
+import asyncio
 import os
 import sys
+import time
 from datetime import datetime, timezone
 from pathlib import Path
 
 import azure as az
+import history
 import image as img
+import locks
 import loggers
 import packer
+import repos
 
 # indicates if the script is running in the docker container
 in_builder = os.environ.get('ACI_IMAGE_BUILDER', False)
 in_builder = True if in_builder else False
 
+# indicates if the script was started by the local executor in build.py, which builds
+# on this machine with the azure cli account that is already signed in
+in_local = True if os.environ.get('BUILD_LOCAL', False) else False
+
 builder_version = os.environ.get('ACI_IMAGE_BUILDER_VERSION', 'unknown')
 
 log = loggers.getLogger(__name__)
@@ -25,9 +34,10 @@ log = loggers.getLogger(__name__)
 log.info(f'ACI_IMAGE_BUILDER: {in_builder}')
 log.info(f'ACI_IMAGE_BUILDER_VERSION: {builder_version}')
 log.debug(f'in_builder: {in_builder}')
+log.debug(f'in_local: {in_local}')
 
 
-if not in_builder:
+if not in_builder and not in_local:
     log.warning('Running outside of the builder container. This should only be done during testing.')
 
 
@@ -36,8 +46,8 @@ def error_exit(message):
     sys.exit(message)
 
 
-repo = Path('/mnt/repo') if in_builder else Path(__file__).resolve().parent.parent
-storage = Path('/mnt/storage') if in_builder else repo / '.local' / 'storage'
+repo = Path(os.environ.get('BUILD_REPO_PATH', '/mnt/repo' if in_builder else Path(__file__).resolve().parent.parent))
+storage = Path(os.environ.get('BUILD_STORAGE_PATH', '/mnt/storage' if in_builder else repo / '.local' / 'storage'))
 
 log.info(f'Repository path: {repo}')
 log.info(f'Storage path: {storage}')
@@ -45,6 +55,10 @@ log.info(f'Storage path: {storage}')
 if not os.path.isdir(repo):
     error_exit(f'Missing volume {repo}')
 
+# when set the repo volume is empty and the repository is checked out from a mirror on the storage volume
+repo_url = os.environ.get('BUILD_REPO_URL', None)
+repo_revision = os.environ.get('BUILD_REPO_REVISION', None) or None
+
 if not os.path.isdir(storage):
     log.warning(f'Missing volume {storage}')
 
@@ -52,41 +66,162 @@ for env in ['BUILD_IMAGE_NAME']:
     if not os.environ.get(env, False):
         error_exit(f'Missing {env} environment variable')
 
-image_name = os.environ['BUILD_IMAGE_NAME']
-image_path = repo / 'images' / image_name
+# a comma separated list of images lets one container (one repo clone and az login) build several images
+image_names = [n.strip() for n in os.environ['BUILD_IMAGE_NAME'].split(',') if n.strip()]
+
+# the versions assigned by build.py, which may differ from image.yaml when using --auto-version.
+# either one version for every image or a comma separated list in the same order as the images
+image_versions = [None if v.strip() == 'latest' else v.strip() for v in os.environ.get('BUILD_IMAGE_VERSION', 'latest').split(',')]
+
+if len(image_versions) == 1:
+    image_versions = image_versions * len(image_names)
+elif len(image_versions) != len(image_names):
+    error_exit(f'BUILD_IMAGE_VERSION has {len(image_versions)} versions but BUILD_IMAGE_NAME has {len(image_names)} images')
+
+# maximum number of packer builds running at the same time
+max_builds = int(os.environ.get('BUILD_MAX_CONCURRENCY', 2))
 
-log.info(f'Image name: {image_name}')
-log.info(f'Image path: {image_path}')
+# build.py replicates the image versions to their replicaLocations after the builds finish
+defer_replication = os.environ.get('BUILD_DEFER_REPLICATION', 'false').lower() == 'true'
+log.info(f'Defer replication: {defer_replication}')
+
+for image_name, image_version in zip(image_names, image_versions):
+    log.info(f'Image name: {image_name}')
+    log.info(f'Image path: {repo / "images" / image_name}')
+    log.info(f'Image version: {image_version or "from image.yaml"}')
+
+if repo_url:
+    if not os.path.isdir(storage):
+        error_exit(f'Missing volume {storage} required to mirror the repository')
+
+    # only the images being built, plus the builder sources and scripts they are fingerprinted with
+    repo_paths = ['builder', 'scripts'] + [f'images/{n}' for n in image_names]
+    commit = repos.materialize(repo_url, repo, repo_paths, storage / 'mirrors', repo_revision)
+    log.info(f'Repository commit: {commit}')
 
 suffix = datetime.now(timezone.utc).strftime('%Y%m%d%H%M%S')
 log.info(f'Build Suffix: {suffix}')
 
-if in_builder:
-    az_client_id = os.environ.get('AZURE_CLIENT_ID', None)
-    az_client_secret = os.environ.get('AZURE_CLIENT_SECRET', None)
-    az_tenant_id = os.environ.get('AZURE_TENANT_ID', None)
+# az failures are raised as exceptions so one image's failure doesn't stop the others, here they end the build
+try:
+    if in_builder:
+        az_client_id = os.environ.get('AZURE_CLIENT_ID', None)
+        az_client_secret = os.environ.get('AZURE_CLIENT_SECRET', None)
+        az_tenant_id = os.environ.get('AZURE_TENANT_ID', None)
+
+        if az_client_id and az_client_secret and az_tenant_id:
+            log.info(f'Found credentials for Azure Service Principal')
+            log.info(f'Logging in with Service Principal')
+            az.cli(f'az login --service-principal -u {az_client_id} -p {az_client_secret} -t {az_tenant_id} --allow-no-subscriptions', log_command=False)
+        else:
+            log.info(f'No credentials for Azure Service Principal')
+            log.info(f'Logging in to Azure with managed identity')
+            az.cli('az login --identity --allow-no-subscriptions')
+
+    gallery = img.get_gallery()
+    common = img.get_common()
+except az.AzCliError as e:
+    error_exit(str(e))
+
+skip_build = not in_builder and not in_local
+
+
+class _Output:
+    '''Prefixes a build's packer output with the image name and keeps a copy in its own log file'''
+
+    def __init__(self, image_name):
+        self.image_name = image_name
+        # one handle for the whole build, opening the file on the storage share for every line is slow
+        self.file = open(storage / f'packer_{loggers.timestamp}_{image_name}.txt', 'a', buffering=1) if os.path.isdir(storage) else None
+
+    def __call__(self, message):
+        if self.file:
+            self.file.write(message + '\n')
+        for line in message.splitlines() or ['']:
+            print(f'[{self.image_name}] {line}', flush=True)
+
+    def close(self):
+        if self.file:
+            self.file.close()
 
-    if az_client_id and az_client_secret and az_tenant_id:
-        log.info(f'Found credentials for Azure Service Principal')
-        log.info(f'Logging in with Service Principal')
-        az.cli(f'az login --service-principal -u {az_client_id} -p {az_client_secret} -t {az_tenant_id} --allow-no-subscriptions', log_command=False)
-    else:
-        log.info(f'No credentials for Azure Service Principal')
-        log.info(f'Logging in to Azure with managed identity')
-        az.cli('az login --identity --allow-no-subscriptions')
 
-gallery = img.get_gallery()
-common = img.get_common()
+async def _build_async(image_name, image_version, slots) -> str:
+    '''Resolves and builds an image, returning the result of the build'''
+    image = await img.get_async(image_name, gallery, common, suffix, ensure_azure=True, version=image_version)
 
-image = img.get(image_name, gallery, common, suffix, ensure_azure=True)
+    if not image['build']:
+        return f'skipped (version {image["version"]} already exists)'
 
-skip_build = not in_builder
+    output = _Output(image_name) if len(image_names) > 1 else None
+    try:
+        return await _run_build_async(image, slots, output)
+    finally:
+        if output:
+            output.close()
 
-if image['build']:
-    packer.save_vars_file(image)
 
-    if not skip_build:
-        packer.execute(image)
+async def _run_build_async(image, slots, output) -> str:
+    '''Builds a resolved image, returning the result of the build'''
+    image_name = image['name']
+
+    if defer_replication:  # packer only publishes to the build region, so the build doesn't wait for the replication
+        location = await img.get_location_async(image)
+        if not location:
+            raise RuntimeError(f'Could not determine the location {image_name} is built in to publish it to')
+        image['replicaLocations'] = [location]
+
+    await packer.save_vars_file_async(image, output)
+
+    if skip_build:
+        return 'skipped (--skip-build)'
+
+    async with slots:
+        start = time.monotonic()
+        returncode = await packer.execute_async(image, output=output)
+        duration = time.monotonic() - start
+
+    if returncode != 0:
+        raise RuntimeError(f'Packer build for {image_name} failed with exit code {returncode}')
+
+    await az.tag_image_version_async(image, {img.FINGERPRINT_TAG: image['fingerprint']})
+
+    # only successful builds are recorded, failures end early and would skew the expected duration.
+    # the history only orders later builds, so a build that can't be recorded still succeeded
+    try:
+        await asyncio.to_thread(history.record, image_name, duration)
+    except (locks.LockTimeout, OSError) as e:
+        log.warning(f'Could not record the build duration of {image_name}: {e}')
+
+    return f'built version {image["version"]}'
+
+
+async def _build_all_async() -> dict:
+    '''Builds all the images, each build's failure is isolated from the others'''
+    slots = asyncio.Semaphore(max(max_builds, 1))
+
+    async def _result(image_name, image_version):
+        try:
+            return None, await _build_async(image_name, image_version, slots)
+        except (Exception, SystemExit) as e:  # image and packer errors still exit with error_exit
+            log.error(f'Failed to build image {image_name}: {e}')
+            return str(e) if str(e) else type(e).__name__, None
+
+    results = await asyncio.gather(*[_result(n, v) for n, v in zip(image_names, image_versions)])
+    return dict(zip(image_names, results))
+
+
+results = asyncio.run(_build_all_async())
+
+log.info('Summary:')
+for image_name, (error, result) in results.items():
+    if error:
+        log.error(f'  {image_name}: failed ({error.strip().splitlines()[-1]})')
+    else:
+        log.info(f'  {image_name}: {result}')
 
 if skip_build:
     log.warning('Skipping build execution because --skip-build was provided')
+
+failed = [n for n, (error, result) in results.items() if error]
+if failed:
+    error_exit(f'Failed to build {len(failed)} of {len(results)} images: {", ".join(failed)}')
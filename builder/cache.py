@@ -0,0 +1,223 @@
+# ------------------------------------
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+# ------------------------------------
+
+import hashlib
+import json
+import os
+import time
+from pathlib import Path
+
+import locks
+import loggers
+
+# seconds to cache the responses of read-only az commands
+TTLS = {
+    'account show': 300,
+    'sig image-definition show': 600,
+    'sig image-definition list': 300,
+    'sig image-version show': 120,
+    'resource list': 120
+}
+
+# commands that change resources and invalidate cached responses in the same resource group
+MUTATING_COMMANDS = ['group create', 'deployment group create', 'sig image-definition create',
+                     'sig image-version create', 'sig image-version update', 'sig image-version delete']
+
+# commands that sign out and invalidate all cached responses. login and account set don't need to
+# because responses for commands without --subscription are keyed by the azure cli profile
+ACCOUNT_COMMANDS = ['logout']
+
+# options that don't change the response
+IGNORED_OPTIONS = ['--only-show-errors']
+
+# options that add status which changes while it is being polled (ex. replication status), responses with them aren't cached
+UNCACHED_OPTIONS = ['--expand']
+
+MAX_ENTRIES = 256
+
+log = loggers.getLogger(__name__)
+
+# indicates if the script is running in the docker container
+in_builder = os.environ.get('ACI_IMAGE_BUILDER', False)
+
+repo = Path(os.environ.get('BUILD_REPO_PATH', '/mnt/repo' if in_builder else Path(__file__).resolve().parent.parent))
+storage = Path(os.environ.get('BUILD_STORAGE_PATH', '/mnt/storage' if in_builder else repo / '.local' / 'storage'))
+
+cache_dir = storage / 'cache' / 'az'
+
+# the cache is only used in the builder container if a storage volume is mounted
+enabled = os.environ.get('AZURE_BUILDER_CACHE', '1') != '0' and (not in_builder or os.path.isdir(storage))
+
+
+def _parse_args(args):
+    '''Splits az cli args into the command (ex. sig image-definition show) and a dict of normalized options'''
+    verbs = []
+    opts = {}
+
+    i = 0
+    while i < len(args) and not args[i].startswith('-'):
+        verbs.append(args[i])
+        i += 1
+
+    while i < len(args):
+        if i + 1 < len(args) and not args[i + 1].startswith('-'):
+            opts[args[i]] = args[i + 1].lower()
+            i += 2
+        else:  # flag without a value
+            opts[args[i]] = True
+            i += 1
+
+    for o in IGNORED_OPTIONS:
+        opts.pop(o, None)
+
+    return ' '.join(verbs), opts
+
+
+def _profile():
+    '''Returns a hash of the azure cli profile so responses for commands without --subscription are keyed by the signed in account'''
+    config_dir = Path(os.environ.get('AZURE_CONFIG_DIR', Path.home() / '.azure'))
+    try:
+        with open(config_dir / 'azureProfile.json', 'rb') as f:
+            return hashlib.sha256(f.read()).hexdigest()
+    except OSError:
+        return None
+
+
+def _scope(opts):
+    subscription = opts.get('--subscription') or _profile()
+    return {'subscription': subscription, 'group': opts.get('-g', opts.get('--resource-group'))}
+
+
+def _key(command, opts):
+    return hashlib.sha256(json.dumps([command, _scope(opts)['subscription'], sorted(opts.items())]).encode()).hexdigest()
+
+
+def _entries():
+    if not cache_dir.is_dir():
+        return []
+    return [e for e in cache_dir.iterdir() if e.suffix == '.json']
+
+
+def _read(path):
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _remove(path):
+    try:
+        path.unlink()
+    except OSError:
+        pass
+
+
+def read_only(args) -> bool:
+    '''Returns True if the az command (without the az executable) only reads resources'''
+    command, _ = _parse_args(args)
+    return command in TTLS or command.endswith(' show') or command.endswith(' list')
+
+
+def get(args):
+    '''Returns (True, response) if a fresh response for a read-only az command (without the az executable) is cached'''
+    if not enabled:
+        return False, None
+
+    command, opts = _parse_args(args)
+
+    if command not in TTLS or any(o in opts for o in UNCACHED_OPTIONS):
+        return False, None
+
+    path = cache_dir / f'{_key(command, opts)}.json'
+    entry = _read(path)
+
+    if entry is None:
+        return False, None
+
+    if entry['expires'] < time.time():
+        _remove(path)
+        return False, None
+
+    log.info(f'Using cached response for az {command} ({int(entry["expires"] - time.time())}s remaining)')
+    return True, entry['value']
+
+
+def put(args, value):
+    '''Caches the response for a read-only az command (without the az executable)'''
+    if not enabled or value is None:  # don't cache missing resources as they are likely about to be created
+        return
+
+    command, opts = _parse_args(args)
+
+    if command not in TTLS or any(o in opts for o in UNCACHED_OPTIONS):
+        return
+
+    entry = {
+        'command': command,
+        'scope': _scope(opts),
+        'expires': time.time() + TTLS[command],
+        'value': value
+    }
+
+    with locks.replacing(cache_dir / f'{_key(command, opts)}.json') as temp, open(temp, 'w') as f:
+        json.dump(entry, f)
+
+    _evict()
+
+
+def _evict():
+    '''Removes expired entries and then the oldest entries until the cache is within MAX_ENTRIES'''
+    entries = _entries()
+
+    if len(entries) <= MAX_ENTRIES:
+        return
+
+    now = time.time()
+    for path in list(entries):
+        entry = _read(path)
+        if entry is None or entry['expires'] < now:
+            _remove(path)
+            entries.remove(path)
+
+    if len(entries) > MAX_ENTRIES:
+        entries.sort(key=lambda p: p.stat().st_mtime if p.exists() else 0)
+        for path in entries[:len(entries) - MAX_ENTRIES]:
+            _remove(path)
+
+
+def invalidate(args):
+    '''Removes the cached responses affected by a mutating az command (without the az executable)'''
+    if not enabled:
+        return
+
+    command, opts = _parse_args(args)
+
+    if command in ACCOUNT_COMMANDS:
+        clear()
+        return
+
+    if command not in MUTATING_COMMANDS:
+        return
+
+    scope = _scope(opts)
+
+    if command == 'group create':
+        scope['group'] = opts.get('-n', opts.get('--name'))
+
+    for path in _entries():
+        entry = _read(path)
+        if entry is None:
+            continue
+        if entry['scope'] != scope:
+            continue
+        log.info(f'Invalidating cached response for az {entry["command"]}')
+        _remove(path)
+
+
+def clear():
+    '''Removes all cached responses'''
+    for path in _entries():
+        _remove(path)
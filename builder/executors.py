@@ -0,0 +1,152 @@
+# ------------------------------------
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+# ------------------------------------
+
+import asyncio
+import os
+import sys
+from pathlib import Path
+
+import azure as az
+import locks
+import loggers
+
+BUILDER_SCRIPT = Path(__file__).resolve().parent / 'builder.py'
+
+log = loggers.getLogger(__name__)
+
+repo = Path(os.environ.get('BUILD_REPO_PATH', Path(__file__).resolve().parent.parent))
+storage = Path(os.environ.get('BUILD_STORAGE_PATH', repo / '.local' / 'storage'))
+
+
+class AciExecutor:
+    '''Runs each build in an azure container instance by deploying the builder template'''
+
+    name = 'aci'
+
+    def __init__(self, no_wait=False, images_per_builder=1):
+        self.no_wait = no_wait
+        self.images_per_builder = max(images_per_builder, 1)
+        self.template_file = None
+        # each builder runs in its own container instance, the deploy limit only bounds
+        # the deployment calls so nothing bounds how many builds run at the same time
+        self.slots = None
+
+    def group(self, images) -> list:
+        '''Splits the images into the images built by each container instance, up to images_per_builder images that share a build resource group are built together'''
+        groups = []
+        shared = {}
+
+        for image in images:
+            # images with a temp resource group deploy their builder to their own resource group
+            if self.images_per_builder == 1 or not image['build'] or image.get('tempResourceGroup'):
+                groups.append([image])
+                continue
+
+            key = (image['subscription'], image['buildResourceGroup'])
+            if key not in shared or len(shared[key]) == self.images_per_builder:
+                shared[key] = []
+                groups.append(shared[key])
+            shared[key].append(image)
+
+        # the builder is named after the first image and its status is the status of every image in the group
+        for group in groups:
+            for image in group[1:]:
+                image['builder'] = group[0]['name']
+
+        return groups
+
+    async def prepare_async(self):
+        '''Compiles the builder template once so the deployments don't all transpile (and try to install) bicep at the same time'''
+        self.template_file = await az.compile_bicep_async()
+
+    async def run_async(self, image, params_file, wait=False) -> str:
+        '''Deploys the image's builder, and when wait is True waits for the build to finish and returns its state'''
+        await az.deploy_builder_async(image, params_file, self.template_file, self.no_wait and not wait)
+        return await az.wait_for_builder_async(image) if wait else None
+
+    async def finish_async(self, images):
+        '''Waits for the builders that were deployed without waiting to be provisioned'''
+        if self.no_wait:
+            await az.wait_for_builders_async(images)
+
+    def prepare(self):
+        return asyncio.run(self.prepare_async())
+
+    def run(self, image, params_file, wait=False) -> str:
+        return asyncio.run(self.run_async(image, params_file, wait))
+
+    def finish(self, images):
+        return asyncio.run(self.finish_async(images))
+
+
+class LocalExecutor:
+    '''Runs each build in a builder.py process on this machine, so self-hosted runners can build without the container instance round trip'''
+
+    name = 'local'
+
+    def __init__(self, params, jobs=1):
+        self.params = params
+        self.slots = max(jobs, 1)
+        # shared by the event loops of every thread, waiting builds don't hold a thread
+        self._pool = locks.FairSemaphore(self.slots)
+
+    def _env(self, image) -> dict:
+        '''Gets the environment the builder container would get from the builder template'''
+        env = dict(os.environ)
+        env.pop('ACI_IMAGE_BUILDER', None)
+
+        env.update({
+            'BUILD_LOCAL': '1',
+            'BUILD_IMAGE_NAME': image['name'],
+            'BUILD_IMAGE_VERSION': image['version'],
+            'BUILD_REPO_PATH': str(repo),
+            'BUILD_STORAGE_PATH': str(storage)
+        })
+
+        if self.params.get('deferReplication'):
+            env['BUILD_DEFER_REPLICATION'] = 'true'
+
+        if self.params.get('clientId') and self.params.get('clientSecret'):
+            env['AZURE_CLIENT_ID'] = self.params['clientId']
+            env['AZURE_CLIENT_SECRET'] = self.params['clientSecret']
+
+        for k, v in self.params.get('packerVars', {}).items():
+            env[f'PKR_VAR_{k}'] = str(v)
+
+        return env
+
+    def group(self, images) -> list:
+        '''Splits the images into the images built by each builder process, each image has its own process'''
+        return [[image] for image in images]
+
+    async def prepare_async(self):
+        storage.mkdir(parents=True, exist_ok=True)
+
+    async def run_async(self, image, params_file=None, wait=True) -> str:
+        '''Runs builder.py for the image once a process slot is free, capturing its output in a log file, and returns the state of the build'''
+        async with self._pool:
+            log_file = storage / f'log_{loggers.timestamp}_{image["name"]}.txt'
+            log.info(f'Running builder for {image["name"]} locally, logging to {log_file}')
+
+            with open(log_file, 'w') as f:
+                proc = await asyncio.create_subprocess_exec(sys.executable, str(BUILDER_SCRIPT), env=self._env(image),
+                                                            stdout=f, stderr=asyncio.subprocess.STDOUT)
+                returncode = await proc.wait()
+
+        state = 'Succeeded' if returncode == 0 else 'Failed'
+        log.info(f'Builder for {image["name"]} finished with state {state} (exit code {returncode})')
+        return state
+
+    async def finish_async(self, images):
+        pass  # builds run to completion in run_async
+
+    def prepare(self):
+        return asyncio.run(self.prepare_async())
+
+    def run(self, image, params_file=None, wait=True) -> str:
+        return asyncio.run(self.run_async(image, params_file, wait))
+
+    def finish(self, images):
+        return asyncio.run(self.finish_async(images))
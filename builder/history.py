@@ -0,0 +1,119 @@
+# ------------------------------------
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+# ------------------------------------
+
+import heapq
+import json
+import os
+import statistics
+from pathlib import Path
+
+import locks
+import loggers
+
+HISTORY_FILE = 'history.json'
+
+# number of recent build durations kept per image
+MAX_SAMPLES = 10
+
+# seconds assumed for images that have never been built
+DEFAULT_DURATION = 3600
+
+log = loggers.getLogger(__name__)
+
+# indicates if the script is running in the docker container
+in_builder = os.environ.get('ACI_IMAGE_BUILDER', False)
+
+repo = Path(os.environ.get('BUILD_REPO_PATH', '/mnt/repo' if in_builder else Path(__file__).resolve().parent.parent))
+storage = Path(os.environ.get('BUILD_STORAGE_PATH', '/mnt/storage' if in_builder else repo / '.local' / 'storage'))
+
+# builds record their durations on the storage volume they run with. local builds share the runner's
+# storage, which build.py schedules from, while container instance builds record to their own file share
+history_file = storage / HISTORY_FILE
+
+
+def _samples(value) -> list:
+    '''Normalizes the durations of an image from a history or user supplied file to a list of seconds'''
+    values = value if isinstance(value, list) else [value]
+    return [float(v) for v in values if isinstance(v, (int, float)) and v > 0]
+
+
+def read(path) -> dict:
+    '''Reads build durations from a history file ({image: seconds or [seconds]}) or packer build profiles (a profile or a list of them)'''
+    try:
+        with open(path, 'r') as f:
+            data = json.load(f)
+    except (OSError, ValueError) as e:
+        log.warning(f'Could not read build durations from {path}: {e}')
+        return {}
+
+    history = {}
+
+    profiles = data if isinstance(data, list) else [data] if 'image' in data else []
+    for p in profiles:
+        if isinstance(p, dict) and p.get('image') and p.get('returncode', 0) == 0:
+            history.setdefault(p['image'], []).extend(_samples(p.get('duration')))
+
+    if not profiles:
+        for name, value in data.items():
+            history.setdefault(name, []).extend(_samples(value))
+
+    return history
+
+
+def merge(history, other) -> dict:
+    '''Adds the durations in other to history, keeping the most recent MAX_SAMPLES per image'''
+    for name, samples in other.items():
+        history[name] = (history.get(name, []) + samples)[-MAX_SAMPLES:]
+    return history
+
+
+def load(paths=None) -> dict:
+    '''Loads the local history store and merges the durations from any user supplied files'''
+    history = read(history_file) if history_file.is_file() else {}
+
+    for path in paths or []:
+        merge(history, read(path))
+
+    return history
+
+
+def record(image_name, duration):
+    '''Adds a build duration to the history store on the storage volume'''
+    if in_builder and not os.path.isdir(storage):
+        return
+
+    with locks.FileLock(storage / f'{HISTORY_FILE}.lock', timeout=60):
+        history = merge(read(history_file) if history_file.is_file() else {}, {image_name: _samples(duration)})
+
+        with locks.replacing(history_file) as temp, open(temp, 'w') as f:
+            json.dump(history, f, indent=4, sort_keys=True)
+
+    log.info(f'Recorded build duration of {duration:.0f}s for {image_name} in {history_file}')
+
+
+def expected(history, name) -> float:
+    '''Gets the expected build duration of an image, the median of its recent builds'''
+    samples = history.get(name)
+    return statistics.median(samples) if samples else DEFAULT_DURATION
+
+
+def longest_first(names, history) -> list:
+    '''Orders images by expected build duration, longest first'''
+    return sorted(names, key=lambda n: expected(history, n), reverse=True)
+
+
+def makespan(names, history, slots) -> float:
+    '''Predicts the total time to build the images in order when at most slots builds run at the same time'''
+    finish = [0.0] * max(min(slots, len(names)), 1)
+
+    for name in names:  # each image starts on the slot that frees up first
+        heapq.heapreplace(finish, finish[0] + expected(history, name))
+
+    return max(finish)
+
+
+def format_duration(seconds) -> str:
+    hours, remainder = divmod(int(seconds), 3600)
+    return f'{hours}h{remainder // 60:02d}m' if hours else f'{remainder // 60}m{remainder % 60:02d}s'
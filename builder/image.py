@@ -4,20 +4,24 @@
 # ------------------------------------
 
 import argparse
+import asyncio
+import hashlib
 import json
 import os
+import re
 import sys
 from datetime import datetime, timezone
 from pathlib import Path
 
 import azure as az
 import loggers
+import packer
 import syaml
 
 IMAGE_REQUIRED_PROPERTIES = ['publisher', 'offer', 'sku', 'version', 'os', 'replicaLocations']
 IMAGE_ALLOWED_PROPERTIES = ['publisher', 'offer', 'sku', 'version', 'os', 'replicaLocations', 'description',
                             'buildResourceGroup', 'keyVault', 'virtualNetwork', 'virtualNetworkSubnet',
-                            'virtualNetworkResourceGroup', 'subscription']
+                            'virtualNetworkResourceGroup', 'subscription', 'base']
 
 COMMON_ALLOWED_PROPERTIES = ['publisher', 'offer', 'replicaLocations', 'buildResourceGroup', 'keyVault',
                              'virtualNetwork', 'virtualNetworkSubnet', 'virtualNetworkResourceGroup', 'subscription']
@@ -25,12 +29,31 @@ COMMON_ALLOWED_PROPERTIES = ['publisher', 'offer', 'replicaLocations', 'buildRes
 GALLERY_REQUIRED_PROPERTIES = ['name', 'resourceGroup']
 GALLERY_ALLOWED_PROPERTIES = ['name', 'resourceGroup', 'subscription']
 
+# files that are shared by all images, a change to any of them affects every image
+SHARED_PATHS = ['images/images.yml', 'images/images.yaml', 'gallery.yml', 'gallery.yaml', 'builder/']
+
+# comments in packer templates (commented out provisioners aren't dependencies)
+TEMPLATE_COMMENT = re.compile(r'/\*.*?\*/|^\s*(#|//).*?$', re.DOTALL | re.MULTILINE)
+# references to scripts in packer templates (ex. "${path.root}/../../scripts/Install-Git.ps1")
+TEMPLATE_SCRIPT_REFERENCE = re.compile(r'scripts/[^"\'\s]+?\.ps1', re.IGNORECASE)
+# references to other scripts in scripts (ex. . $PSScriptRoot\Helpers.ps1)
+SCRIPT_REFERENCE = re.compile(r'[\w./\\-]+\.ps1', re.IGNORECASE)
+
+# the gallery image version tag that stores the fingerprint of the inputs the version was built from
+FINGERPRINT_TAG = 'buildFingerprint'
+
+# files written to the image directory during a build that must not change its fingerprint
+GENERATED_FILES = ['vars.auto.pkrvars.json', 'builder.parameters.json', 'image.parameters.json']
+
+# image properties that are set per build and don't change the content of the image
+FINGERPRINT_EXCLUDED_PROPERTIES = ['version', 'build', 'path', 'location', 'tempResourceGroup', 'subscription', 'gallery', 'fingerprint']
+
 log = loggers.getLogger(__name__)
 
 # indicates if the script is running in the docker container
 in_builder = os.environ.get('ACI_IMAGE_BUILDER', False)
 
-repo = Path('/mnt/repo') if in_builder else Path(__file__).resolve().parent.parent
+repo = Path(os.environ.get('BUILD_REPO_PATH', '/mnt/repo' if in_builder else Path(__file__).resolve().parent.parent))
 images_root = repo / 'images'
 
 default_suffix = datetime.now(timezone.utc).strftime('%Y%m%d%H%M')
@@ -123,6 +146,76 @@ def _validate(image):
     log.info(f'Image {image["name"]} passed full validation')
 
 
+def _lint_image(image_name, common, errors):
+    '''Collects the errors in an image's image.yaml file and its merged common properties without calling azure'''
+    image_dir = images_root / image_name
+
+    image_path = syaml.get_file(image_dir, 'image', required=True, errors=errors)
+    if image_path is None:
+        return
+
+    image = syaml.parse(image_path, errors=errors)
+    lines = syaml.key_lines(image_path)
+
+    merged = common.copy()
+    merged.update(image)
+
+    syaml.validate(image_path, merged, required=IMAGE_REQUIRED_PROPERTIES, allowed=IMAGE_ALLOWED_PROPERTIES, errors=errors)
+
+    def _error(key, message):
+        # properties inherited from images.yaml don't have a line in image.yaml
+        errors.append({'file': f'{image_path}', 'line': lines.get(key), 'column': None, 'message': f'{message} for image {image_name}'})
+
+    # missing required properties were reported by validate, only check the ones that have values
+    if _has_key_and_value(merged, 'version') and not re.fullmatch(r'\d+\.\d+\.\d+', f'{merged["version"]}'):
+        _error('version', f'version {merged["version"]} is not in the format major.minor.patch (ex. 1.0.0)')
+
+    if _has_key_and_value(merged, 'os') and f'{merged["os"]}'.lower() not in ['windows', 'linux']:
+        _error('os', f'os {merged["os"]} must be Windows or Linux')
+
+    if _has_key_and_value(merged, 'replicaLocations') and not isinstance(merged['replicaLocations'], list):
+        _error('replicaLocations', 'replicaLocations must be an array using - notation')
+
+    for key, other in [('virtualNetworkSubnet', 'virtualNetwork'), ('virtualNetwork', 'virtualNetworkSubnet'),
+                       ('virtualNetworkResourceGroup', 'virtualNetwork')]:
+        if _has_key_and_value(merged, key) and _missing_key_or_value(merged, other):
+            _error(key, f'{key} is defined but {other} is not')
+
+    if not list(image_dir.glob('*.pkr.hcl')):
+        errors.append({'file': f'{image_dir}', 'line': None, 'column': None, 'message': f'no packer template (*.pkr.hcl) found for image {image_name}'})
+    elif _has_key_and_value(merged, 'base') and 'base' not in packer.get_vars({'name': image_name, 'path': image_dir}):
+        # the builder only passes base to packer as a variable, a template without it would silently build from its marketplace image
+        _error('base', f'base is defined but the packer templates don\'t declare a base variable')
+
+
+def lint(names=None) -> dict:
+    '''Validates the gallery, common, and image yaml files without calling azure, collecting all errors instead of exiting on the first'''
+    errors = []
+
+    gallery_path = syaml.get_file(repo, 'gallery', required=True, errors=errors)
+    if gallery_path:
+        syaml.parse(gallery_path, required=GALLERY_REQUIRED_PROPERTIES, allowed=GALLERY_ALLOWED_PROPERTIES, errors=errors)
+
+    common = {}
+    images_path = syaml.get_file(images_root, 'images', required=False, errors=errors)
+    if images_path:
+        common = syaml.parse(images_path, allowed=COMMON_ALLOWED_PROPERTIES, errors=errors)
+
+    names = names if names else image_names()
+
+    for name in names:
+        _lint_image(name, common, errors)
+
+    # the base images of every image, a missing base or a cycle anywhere breaks the build order of all images
+    _check_cycle(graph(image_names(), errors), errors)
+
+    return {
+        'valid': not errors,
+        'images': names,
+        'errors': errors
+    }
+
+
 def _get(image_name, gallery, common=None) -> dict:
     '''Get the image properties from the image.yaml file'''
     image_dir = images_root / image_name
@@ -160,70 +253,238 @@ def _get(image_name, gallery, common=None) -> dict:
     return image
 
 
-def get(image_name, gallery, common=None, suffix=None, ensure_azure=False) -> dict:
-    '''Get the image properties from the image.yaml file optionally supplementing with info from azure'''
-    image = _get(image_name, gallery, common)
+def image_names() -> list:
+    '''Get the list of image names from the images directory'''
+    # images are the direct subdirectories of the images directory, so only read one level
+    with os.scandir(images_root) as entries:
+        names = [e.name for e in entries if e.is_dir()]
 
-    if ensure_azure:
+    return sorted(names)
 
-        # _get() will set the subscription on the image and the gallery if one was
-        # defined on either, if none was defined, set the subscription on the image
-        if _missing_key_or_value(image, 'subscription'):
-            sub = az.get_sub()
-            image['subscription'] = sub
-        # and the gallery
-        if _missing_key_or_value(image['gallery'], 'subscription'):
-            image['gallery']['subscription'] = image['subscription']
 
-        build, image_def = az.ensure_image_def_version(image)
-        image['build'] = build
+def _script_references(script, scripts_root, seen):
+    '''Adds the repo relative path of a script and all the scripts it references (recursively) to seen'''
+    if script in seen:
+        return
+    seen.add(script)
 
-        # if buildResourceGroup is not provided we'll provide a name and location for the resource group
-        if _missing_key_or_value(image, 'buildResourceGroup'):
-            suffix = suffix if suffix else default_suffix
-            image['location'] = image_def['location']
-            image['tempResourceGroup'] = f'{image["gallery"]["name"]}-{image["name"]}-{suffix}'
+    try:
+        with open(repo / script, 'r', encoding='utf-8-sig', errors='ignore') as f:
+            content = f.read()
+    except OSError:
+        return
 
-        log.info(f'Image {image["name"]} properties:')
-        for line in json.dumps(image, indent=4).splitlines():
-            log.info(line)
+    for ref in SCRIPT_REFERENCE.findall(content):
+        # references can be relative to the script or the scripts directory, only keep the ones that exist in the repo
+        for candidate in [(repo / script).parent / ref.replace('\\', '/'), scripts_root / Path(ref.replace('\\', '/')).name]:
+            if candidate.is_file() and scripts_root in candidate.resolve().parents:
+                _script_references(candidate.resolve().relative_to(repo.resolve()).as_posix(), scripts_root, seen)
+                break
 
-        _validate(image)
 
-    return image
+def dependencies(image_name) -> list:
+    '''Get the repo relative paths of the scripts referenced by an image's packer templates, including nested script references'''
+    image_dir = images_root / image_name
+    scripts_root = (repo / 'scripts').resolve()
+    scripts = set()
 
+    for template in sorted(image_dir.glob('*.pkr.hcl')):
+        with open(template, 'r') as f:
+            content = TEMPLATE_COMMENT.sub('', f.read())
+            for ref in TEMPLATE_SCRIPT_REFERENCE.findall(content):
+                _script_references(f'scripts/{ref.split("scripts/", 1)[1]}', scripts_root, scripts)
+
+    return sorted(scripts)
+
+
+def dependency_index(names=None) -> dict:
+    '''Get an index of image name to the repo relative paths (files and directory prefixes) each image depends on'''
+    names = names if names else image_names()
+    return {n: [f'images/{n}/'] + dependencies(n) + SHARED_PATHS for n in names}
+
+
+def base_of(image_name, errors=None) -> str:
+    '''Get the name of the image an image is built on (the base property in its image.yaml) or None'''
+    # when linting (errors is a list) problems with the image.yaml itself are reported by _lint_image
+    scratch = [] if errors is not None else None
+    image_path = syaml.get_file(images_root / image_name, 'image', required=True, errors=scratch)
+    if image_path is None:
+        return None
+    base = syaml.parse(image_path, errors=scratch).get('base')
+    return f'{base}' if base else None
+
+
+def _graph_error(errors, image_name, message):
+    '''Exits with the message, or if an errors list is provided, adds it to the list with the location of the image's base property'''
+    if errors is None:
+        error_exit(message)
+    image_path = syaml.get_file(images_root / image_name, 'image', required=True, errors=[])
+    errors.append({'file': f'{image_path}', 'line': syaml.key_lines(image_path).get('base'), 'column': None, 'message': message})
+
+
+def graph(names=None, errors=None) -> dict:
+    '''Get an index of image name to the name of its base image, for the images that have one. Invalid bases are added to errors when provided'''
+    names = names if names else image_names()
+    bases = {}
 
-def all(gallery, common=None, suffix=None, ensure_azure=False) -> list:
-    '''Get all the image properties from the image.yaml files'''
-    common = common if common else get_common()
-    names = image_names()
     for name in names:
-        log.warning(f'Getting image {name}')
-    images = [get(i, gallery, common, suffix, ensure_azure) for i in image_names()]
-    return images
+        base = base_of(name, errors)
+        if base:
+            if base == name or not (images_root / base).is_dir():
+                _graph_error(errors, name, f'base {base} for image {name} must be the name of another image in the images directory')
+                continue
+            bases[name] = base
 
+    return bases
+
+
+def _cycle(bases) -> list:
+    '''Get the images in a cycle of base images or None'''
+    for name in bases:
+        path = [name]
+        while path[-1] in bases:
+            path.append(bases[path[-1]])
+            if path[-1] in path[:-1]:
+                return path[path.index(path[-1]):]
+    return None
+
+
+def _check_cycle(bases, errors=None):
+    '''Exits if the base images form a cycle, or if an errors list is provided, adds the cycle to it'''
+    cycle = _cycle(bases)
+    if cycle:
+        _graph_error(errors, cycle[0], f'base images form a cycle: {" -> ".join(cycle)}')
+
+
+def waves(names=None) -> list:
+    '''Orders images into waves where each image's base (when it is also being built) is in an earlier wave'''
+    names = names if names else image_names()
+    bases = graph(image_names())
+
+    _check_cycle(bases)
+
+    remaining = list(names)
+    result = []
+
+    while remaining:
+        # images built on an image from the remaining list wait for it to be published
+        wave = [n for n in remaining if bases.get(n) not in remaining]
+        result.append(wave)
+        remaining = [n for n in remaining if n not in wave]
+
+    return result
+
+
+def dependents(names, all_names=None) -> list:
+    '''Get the images built on any of the images, directly or through other images'''
+    bases = graph(image_names())
+    candidates = all_names if all_names else image_names()
+
+    _check_cycle(bases)
+
+    found = []
+    for name in candidates:
+        base = bases.get(name)
+        while base and base not in names:
+            base = bases.get(base)
+        if base and name not in names:
+            found.append(name)
+
+    return sorted(found)
+
+
+def _normalize_change(path):
+    path = Path(path)
+    if path.is_absolute():
+        try:
+            path = path.resolve().relative_to(repo.resolve())
+        except ValueError:
+            return None
+    return path.as_posix()
+
+
+def affected(changes, names=None) -> list:
+    '''Get the names of the images affected by a list of changed file paths (relative to the repo root)'''
+    changes = [c for c in (_normalize_change(c) for c in changes) if c]
+    index = dependency_index(names)
+
+    affected_names = []
+    for name, paths in index.items():
+        for change in changes:
+            if any(change.lower() == p.lower() or (p.endswith('/') and change.lower().startswith(p.lower())) for p in paths):
+                log.info(f'Image {name} is affected by change to {change}')
+                affected_names.append(name)
+                break
+
+    # images built on an affected image start from its new version, so they are affected too
+    for name in dependents(affected_names, names):
+        log.info(f'Image {name} is affected because it is built on an affected image')
+        affected_names.append(name)
+
+    return affected_names
+
+
+def _hash_files(digest, paths):
+    for path in paths:
+        digest.update(path.relative_to(repo).as_posix().encode())
+        with open(path, 'rb') as f:
+            digest.update(f.read().replace(b'\r\n', b'\n'))  # ignore line ending differences between checkouts
+
+
+def fingerprint(image) -> str:
+    '''Computes a deterministic fingerprint over the image directory, the scripts it references, its properties, and the builder sources'''
+    image_dir = Path(image['path'])
+    builder_dir = repo / 'builder'
+
+    digest = hashlib.sha256()
+
+    _hash_files(digest, sorted(p for p in builder_dir.rglob('*') if p.is_file() and '__pycache__' not in p.parts))
+    _hash_files(digest, sorted(p for p in image_dir.rglob('*') if p.is_file() and p.name not in GENERATED_FILES))
+    _hash_files(digest, [repo / s for s in dependencies(image['name'])])
+
+    properties = {k: v for k, v in image.items() if k not in FINGERPRINT_EXCLUDED_PROPERTIES}
+    properties['gallery'] = {k: image['gallery'][k] for k in ['name', 'resourceGroup']}
+    digest.update(json.dumps(properties, sort_keys=True).encode())
+
+    return digest.hexdigest()
 
-def image_names() -> list:
-    '''Get the list of image names from the images directory'''
-    names = []
 
-    # walk the images directory and find all the image.yml/image.yaml files
-    for dirpath, dirnames, files in os.walk(images_root):
-        # os.walk includes the root directory (i.e. repo/images) so we need to skip it
-        if not images_root.samefile(dirpath) and Path(dirpath).parent.samefile(images_root):
-            names.append(Path(dirpath).name)
+def _apply_version(image, inventory, skip_unchanged=False, auto_version=False):
+    '''Compares the image fingerprint to the latest published version, skipping or assigning a new version'''
+    latest, latest_version = az.latest_image_version(inventory, image['name'])
+
+    if latest is None:
+        return
+
+    latest_fingerprint = (latest_version.get('tags') or {}).get(FINGERPRINT_TAG)
+    unchanged = latest_fingerprint == image['fingerprint']
+
+    if unchanged and skip_unchanged:
+        log.warning(f'{image["name"]} was not built because its inputs are unchanged since version {latest}')
+        image['build'] = False
+        image['unchanged'] = latest
+
+    elif not unchanged and auto_version and az.next_image_version(latest, image['version']) != image['version']:
+        version = az.next_image_version(latest, image['version'])
+        log.info(f'Inputs for {image["name"]} changed since version {latest}, using version {version} instead of {image["version"]}')
+        image['version'] = version
 
-    return names
 
 # ----------------
 # async functions
 # ----------------
 
 
-async def get_async(image_name, gallery, common=None, suffix=None, ensure_azure=False) -> dict:
+async def get_async(image_name, gallery, common=None, suffix=None, ensure_azure=False, version=None,
+                    skip_unchanged=False, auto_version=False) -> dict:
     '''Get the image properties from the image.yaml file optionally supplementing with info from azure'''
     image = _get(image_name, gallery, common)
 
+    if version:  # version assigned by build.py (ex. with --auto-version) overrides the version in image.yaml
+        image['version'] = version
+
+    image['fingerprint'] = fingerprint(image)
+
     if ensure_azure:
 
         # _get() will set the subscription on the image and the gallery if one was
@@ -235,11 +496,28 @@ async def get_async(image_name, gallery, common=None, suffix=None, ensure_azure=
         if _missing_key_or_value(image['gallery'], 'subscription'):
             image['gallery']['subscription'] = image['subscription']
 
-        build, image_def = await az.ensure_image_def_version_async(image)
+        if _has_key_and_value(image, 'base'):
+            # the base's latest version is looked up without the inventory (or any cache) so images in a later
+            # wave start from the version published earlier in the same run
+            image['baseVersion'] = await az.get_latest_image_version_async(image['gallery'], image['base'])
+            if image['baseVersion'] is None:
+                error_exit(f'base image {image["base"]} for {image["name"]} has no published versions in gallery {image["gallery"]["name"]}')
+            log.info(f'Image {image["name"]} is built on {image["base"]} version {image["baseVersion"]}')
+            image['fingerprint'] = fingerprint(image)  # a new base version changes the image
+
+        inventory = await az.get_gallery_inventory_async(image['gallery'])
+
+        if auto_version:
+            _apply_version(image, inventory, auto_version=True)
+
+        build, image_def = await az.ensure_image_def_version_async(image, inventory)
         image['build'] = build
 
+        if build and skip_unchanged:
+            _apply_version(image, inventory, skip_unchanged=True)
+
         # if buildResourceGroup is not provided we'll provide a name and location for the resource group
-        if 'buildResourceGroup' not in image or not image['buildResourceGroup']:
+        if _missing_key_or_value(image, 'buildResourceGroup'):
             suffix = suffix if suffix else default_suffix
             image['location'] = image_def['location']
             image['tempResourceGroup'] = f'{image["gallery"]["name"]}-{image["name"]}-{suffix}'
@@ -253,13 +531,55 @@ async def get_async(image_name, gallery, common=None, suffix=None, ensure_azure=
     return image
 
 
+async def get_location_async(image) -> str:
+    '''Gets the region an image is built in, its location or the location of its existing build resource group'''
+    if _has_key_and_value(image, 'location'):
+        return image['location']
+    if _has_key_and_value(image, 'buildResourceGroup'):
+        return await az.get_group_location_async(image['buildResourceGroup'], image['subscription'])
+    return None
+
+
+async def all_async(gallery, common=None, suffix=None, ensure_azure=False, skip_unchanged=False, auto_version=False) -> list:
+    '''Get all the image properties from the image.yaml files'''
+    common = common if common else get_common()
+    names = image_names()
+    for name in names:
+        log.warning(f'Getting image {name}')
+    images = await asyncio.gather(*[get_async(i, gallery, common, suffix, ensure_azure, skip_unchanged=skip_unchanged,
+                                              auto_version=auto_version) for i in names])
+    return list(images)
+
+
+# ----------------
+# sync functions
+# ----------------
+
+
+def get(image_name, gallery, common=None, suffix=None, ensure_azure=False, version=None,
+        skip_unchanged=False, auto_version=False) -> dict:
+    '''Get the image properties from the image.yaml file optionally supplementing with info from azure'''
+    return asyncio.run(get_async(image_name, gallery, common, suffix, ensure_azure, version, skip_unchanged, auto_version))
+
+
+def all(gallery, common=None, suffix=None, ensure_azure=False, skip_unchanged=False, auto_version=False) -> list:
+    '''Get all the image properties from the image.yaml files'''
+    return asyncio.run(all_async(gallery, common, suffix, ensure_azure, skip_unchanged, auto_version))
+
+
 if __name__ == '__main__':
 
     parser = argparse.ArgumentParser(description='Get image properties from image.yaml files')
     parser.add_argument('--images', '-i', nargs='*', help='names of images to include. if not specified all images will be')
+    parser.add_argument('--lint', action='store_true', help='validate the gallery and image yaml files without calling azure and print a json report of all errors')
 
     args = parser.parse_args()
 
+    if args.lint:
+        report = lint(args.images)
+        print(json.dumps(report, indent=4))
+        sys.exit(0 if report['valid'] else 1)
+
     gallery = get_gallery()
     common = get_common()
 
@@ -0,0 +1,192 @@
+# ------------------------------------
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+# ------------------------------------
+
+import asyncio
+import json
+import os
+import socket
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from pathlib import Path
+
+import loggers
+
+POLL_INTERVAL = 1
+TIMEOUT = 1800
+
+# a lock file older than this is assumed to belong to a container that was stopped while holding it
+STALE_AFTER = 3600
+
+log = loggers.getLogger(__name__)
+
+
+class LockTimeout(Exception):
+    '''Raised when a lock can't be acquired before the timeout'''
+
+
+# the storage volume is an azure file (SMB) share where fcntl/flock locks aren't reliable between containers,
+# but creating a file that must not exist (O_EXCL) is atomic
+class FileLock:
+    '''Inter-process lock backed by a lock file that is created exclusively and removed on release'''
+
+    def __init__(self, path, timeout=TIMEOUT, stale_after=STALE_AFTER):
+        self.path = Path(path)
+        self.timeout = timeout
+        self.stale_after = stale_after
+        self.locked = False
+
+    def _remove_stale(self):
+        try:
+            age = time.time() - self.path.stat().st_mtime
+        except OSError:
+            return  # released between the failed create and now
+
+        if age > self.stale_after:
+            log.warning(f'Removing stale lock {self.path} ({int(age)}s old)')
+            try:
+                self.path.unlink()
+            except OSError:
+                pass
+
+    def try_acquire(self) -> bool:
+        '''Acquires the lock if it is free, returns False without waiting if it is held by another process'''
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+
+        try:
+            fd = os.open(self.path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            self._remove_stale()
+            return False
+
+        with os.fdopen(fd, 'w') as f:  # record the owner to make stuck locks easier to debug
+            json.dump({'host': socket.gethostname(), 'pid': os.getpid(), 'time': time.time()}, f)
+
+        self.locked = True
+        return True
+
+    def acquire(self):
+        '''Waits until the lock is acquired, raises LockTimeout after the timeout'''
+        start = time.time()
+        logged = False
+
+        while not self.try_acquire():
+            if time.time() - start > self.timeout:
+                raise LockTimeout(f'Timed out waiting for lock {self.path}')
+            if not logged:
+                log.info(f'Waiting for lock {self.path}')
+                logged = True
+            time.sleep(POLL_INTERVAL)
+
+    def release(self):
+        '''Releases the lock'''
+        if not self.locked:
+            return
+        self.locked = False
+        try:
+            self.path.unlink()
+        except OSError:
+            log.warning(f'Lock {self.path} was removed while it was held')
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+    async def acquire_async(self):
+        '''Waits until the lock is acquired without blocking the event loop, raises LockTimeout after the timeout'''
+        start = time.time()
+        logged = False
+
+        while not self.try_acquire():
+            if time.time() - start > self.timeout:
+                raise LockTimeout(f'Timed out waiting for lock {self.path}')
+            if not logged:
+                log.info(f'Waiting for lock {self.path}')
+                logged = True
+            await asyncio.sleep(POLL_INTERVAL)
+
+    async def __aenter__(self):
+        await self.acquire_async()
+        return self
+
+    async def __aexit__(self, *args):
+        self.release()
+
+
+# replacing a file is atomic on the storage volume too, so concurrent readers see the old or the new file but never a partial one
+def replace(source, target):
+    '''Moves a file over the target atomically, creating the target's directory if it doesn't exist'''
+    Path(target).parent.mkdir(parents=True, exist_ok=True)
+    os.replace(source, target)
+
+
+@contextmanager
+def replacing(path):
+    '''Yields a temporary path next to the file, which replaces the file when the block succeeds and is removed when it fails'''
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    temp = path.with_name(f'{path.name}.{os.getpid()}.{threading.get_ident()}.tmp')  # in the same directory, so it's on the same volume
+    try:
+        yield temp
+        replace(temp, path)
+    finally:
+        temp.unlink(missing_ok=True)
+
+
+class FairSemaphore:
+    '''Counting semaphore that hands free slots to waiters in the order they started waiting, shared by the event loops of every thread'''
+
+    def __init__(self, value):
+        self._value = value
+        self._waiters = deque()
+        self._lock = threading.Lock()
+
+    async def acquire_async(self):
+        '''Waits for a slot without blocking the event loop or a thread'''
+        loop = asyncio.get_running_loop()
+
+        with self._lock:
+            if self._value > 0 and not self._waiters:
+                self._value -= 1
+                return
+            waiter = (loop, loop.create_future())
+            self._waiters.append(waiter)
+
+        try:
+            await waiter[1]
+        except asyncio.CancelledError:
+            with self._lock:
+                handed = waiter not in self._waiters
+                if not handed:
+                    self._waiters.remove(waiter)
+            if handed:  # the slot was handed over while the waiter was being cancelled, pass it on
+                self.release()
+            raise
+
+    def release(self):
+        '''Hands the slot to the longest waiting waiter, or frees it if nothing is waiting'''
+        with self._lock:
+            if not self._waiters:
+                self._value += 1
+                return
+            loop, future = self._waiters.popleft()
+
+        loop.call_soon_threadsafe(_wake, future)
+
+    async def __aenter__(self):
+        await self.acquire_async()
+        return self
+
+    async def __aexit__(self, *args):
+        self.release()
+
+
+def _wake(future):
+    if not future.cancelled():  # a cancelled waiter passes the slot on itself
+        future.set_result(None)
@@ -3,8 +3,14 @@
 # Licensed under the MIT License.
 # ------------------------------------
 
+import atexit
+import json
 import logging
+import logging.handlers
 import os
+import queue
+import threading
+from contextlib import contextmanager
 from datetime import datetime, timezone
 from pathlib import Path
 
@@ -13,29 +19,132 @@ timestamp = datetime.now(timezone.utc).strftime('%Y%m%d%H%M%S')
 # indicates if the script is running in the docker container
 in_builder = os.environ.get('ACI_IMAGE_BUILDER', False)
 
-repo = Path('/mnt/repo') if in_builder else Path(__file__).resolve().parent.parent
-storage = Path('/mnt/storage') if in_builder else repo / '.local' / 'storage'
+repo = Path(os.environ.get('BUILD_REPO_PATH', '/mnt/repo' if in_builder else Path(__file__).resolve().parent.parent))
+storage = Path(os.environ.get('BUILD_STORAGE_PATH', '/mnt/storage' if in_builder else repo / '.local' / 'storage'))
 
 log_file = storage / f'log_{timestamp}.txt'
 
+# text (default) or json, which writes each record as a json object on its own line
+log_format = os.environ.get('BUILD_LOG_FORMAT', 'text').lower()
+
+# records held back by threads that group their output, see grouped()
+_local = threading.local()
+_flush_lock = threading.Lock()
+
+
+class _GroupFilter(logging.Filter):
+    '''Holds back the records logged by a thread that is grouping its output'''
+
+    def __init__(self, logger):
+        super().__init__()
+        self.logger = logger
+
+    def filter(self, record):
+        records = getattr(_local, 'records', None)
+        if records is None:
+            return True
+        records.append((self.logger, record))
+        return False
+
+
+class _JsonFormatter(logging.Formatter):
+    '''Formats records as json lines'''
+
+    def format(self, record):
+        entry = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            'level': record.levelname,
+            'logger': record.name,
+            'thread': record.threadName,
+            'message': record.getMessage()  # includes the traceback, the queue handler merges it into the message
+        }
+        return json.dumps(entry)
+
+
+@contextmanager
+def grouped():
+    '''Holds back all records logged by the current thread and logs them together on exit so output from concurrent threads isn't interleaved'''
+    _local.records = []
+    try:
+        yield
+    finally:
+        records = _local.records
+        _local.records = None
+        with _flush_lock:
+            for logger, record in records:
+                logger.callHandlers(record)
+
+
+def _formatter() -> logging.Formatter:
+    if log_format == 'json':
+        return _JsonFormatter()
+    return logging.Formatter('{asctime} [{name:^8}] {levelname:<8}: {message}', datefmt='%m/%d/%Y %I:%M:%S %p', style='{',)
 
-def getLogger(name, level=logging.DEBUG):
-    logger = logging.getLogger(name)
-    logger.setLevel(level=level)
 
-    formatter = logging.Formatter('{asctime} [{name:^8}] {levelname:<8}: {message}', datefmt='%m/%d/%Y %I:%M:%S %p', style='{',)
+# every logger puts its records on one queue, and a single listener thread writes them to the console
+# and log file, so logging never waits on the (smb mounted) storage volume and the file is opened once
+_queue = queue.Queue()
+_queue_handler = logging.handlers.QueueHandler(_queue)
+_listener = None
+_setup_lock = threading.Lock()
 
-    ch = logging.StreamHandler()
-    ch.setLevel(level=level)
-    ch.setFormatter(formatter)
 
-    logger.addHandler(ch)
+def _start():
+    '''Starts the listener with the console and file sinks the first time a logger is created'''
+    global _listener
 
-    if in_builder and os.path.isdir(storage):
-        fh = logging.FileHandler(log_file)
-        fh.setLevel(level=level)
-        fh.setFormatter(formatter)
+    with _setup_lock:
+        if _listener is not None:
+            return
+
+        formatter = _formatter()
+
+        ch = logging.StreamHandler()
+        ch.setFormatter(formatter)
+        sinks = [ch]
+
+        if in_builder and os.path.isdir(storage):
+            fh = logging.FileHandler(log_file)
+            fh.setFormatter(formatter)
+            sinks.append(fh)
+
+        _listener = logging.handlers.QueueListener(_queue, *sinks)
+        _listener.start()
+        atexit.register(shutdown)
+
+
+def flush():
+    '''Waits until every record logged so far has been written by the sinks'''
+    if _listener is None:
+        return
+    _queue.join()
+    for sink in _listener.handlers:
+        sink.flush()
+
+
+def shutdown():
+    '''Writes the remaining records and closes the sinks, called when the process exits'''
+    global _listener
+
+    with _setup_lock:
+        if _listener is None:
+            return
+        _listener.stop()
+        for sink in _listener.handlers:
+            sink.close()
+        _listener = None
+
+
+def getLogger(name, level=logging.DEBUG):
+    _start()
+
+    logger = logging.getLogger(name)
+    logger.setLevel(level=level)
 
-        logger.addHandler(fh)
+    # getLogger can be called more than once for the same name, which must not duplicate the output
+    if not any(isinstance(f, _GroupFilter) for f in logger.filters):
+        logger.addFilter(_GroupFilter(logger))
+    if _queue_handler not in logger.handlers:
+        logger.addHandler(_queue_handler)
 
     return logger
@@ -4,26 +4,78 @@
 # ------------------------------------
 
 import asyncio
+import hashlib
 import json
 import os
+import platform
+import re
 import shutil
-import subprocess
 import sys
+import tempfile
+import threading
+import time
 from pathlib import Path
 
+import locks
 import loggers
 
 AUTO_VARS_FILE = 'vars.auto.pkrvars.json'
-DEFAULT_PKR_VARS = ['subscription', 'name', 'location', 'version', 'tempResourceGroup', 'buildResourceGroup',
-                    'gallery', 'replicaLocations', 'keyVault', 'virtualNetwork',  'virtualNetworkSubnet',
-                    'virtualNetworkResourceGroup', 'branch', 'commit']
+
+# the tokens of an hcl file that matter for finding top level variable blocks. strings, heredocs, and comments
+# are matched so the braces and variable keywords in them are skipped
+HCL_TOKENS = re.compile(r'''
+    \bvariable\s+(?:"(?P<quoted>[^"]+)"|(?P<name>[A-Za-z_][\w-]*))\s*\{  # variable "name" {
+    | "(?:[^"\\\n]|\\.)*"                                                # string
+    | <<-?(?P<heredoc>\w+)\n.*?^\s*(?P=heredoc)\s*$                      # heredoc
+    | (?:\#|//)[^\n]* | /\*.*?\*/                                        # comments
+    | [{}]                                                               # braces
+''', re.VERBOSE | re.DOTALL | re.MULTILINE)
+
+# the required_plugins block in a packer block, the plugins in it, and their version and source properties
+REQUIRED_PLUGINS = re.compile(r'required_plugins\s*\{((?:[^{}]|\{[^{}]*\})*)\}')
+REQUIRED_PLUGIN = re.compile(r'([\w-]+)\s*=\s*\{([^{}]*)\}')
+PLUGIN_PROPERTY = re.compile(r'\b(version|source)\s*=\s*"([^"]*)"')
+# only exact version constraints (ex. "0.14.1" or "= 0.14.1") can be checked without running packer init
+EXACT_VERSION = re.compile(r'\s*=?\s*v?(\d+\.\d+\.\d+)\s*')
+
+# bump when the layout of the plugin cache changes
+PLUGIN_CACHE_VERSION = 1
+
+# ui messages that start a provisioner, the group is the name used in events and the timing profile. the powershell,
+# file, windows-update, and windows-restart provisioners used by the images, then any other provisioner
+PROVISIONER_STARTS = [
+    (re.compile(r'Provisioning with (?:powershell|shell|windows-shell) script: (?:.*[\\/])?([^\\/]+)$', re.IGNORECASE), None),
+    (re.compile(r'Uploading (.+) =>'), None),
+    (re.compile(r'Running Windows update'), 'windows-update'),
+    (re.compile(r'Restarting Machine$'), 'windows-restart'),
+    (re.compile(r'Provisioning with (.+?)\.*$'), None)
+]
+# ui messages from the builder after the last provisioner finished
+PROVISIONING_ENDS = [
+    re.compile(r"Querying the machine's properties"),
+    re.compile(r'Powering off machine'),
+    re.compile(r'Capturing image'),
+    re.compile(r'Builds finished')
+]
+# ui messages from the windows-restart provisioner and the windows-update plugin when they restart the machine
+RESTART = re.compile(r'Restarting (?:the )?machine', re.IGNORECASE)
+
+# longer lines are truncated so a misbehaving provisioner can't use unbounded memory
+MAX_LINE = 1024 * 1024
 
 log = loggers.getLogger(__name__)
 
 # indicates if the script is running in the docker container
 in_builder = os.environ.get('ACI_IMAGE_BUILDER', False)
 
-repo = Path('/mnt/repo') if in_builder else Path(__file__).resolve().parent.parent
+repo = Path(os.environ.get('BUILD_REPO_PATH', '/mnt/repo' if in_builder else Path(__file__).resolve().parent.parent))
+storage = Path(os.environ.get('BUILD_STORAGE_PATH', '/mnt/storage' if in_builder else repo / '.local' / 'storage'))
+
+# plugins are platform specific binaries, so each platform gets its own directory
+plugin_dir = storage / 'cache' / 'packer' / f'v{PLUGIN_CACHE_VERSION}' / f'{platform.system().lower()}_{platform.machine().lower()}'
+
+# the plugin cache is only used in the builder container if a storage volume is mounted
+plugin_cache = os.environ.get('PACKER_PLUGIN_CACHE', '1') != '0' and (not in_builder or os.path.isdir(storage))
 
 
 def error_exit(message):
@@ -51,135 +103,388 @@ def _parse_command(command):
     return args
 
 
-def get_vars(image):
-    '''Gets the available packer variables from the variable.pkr.hcl file'''
-    try:
-        args = _parse_command(['inspect', '-machine-readable', image['path']])
-        log.info(f'Running packer command: {" ".join(args)}')
-        proc = subprocess.run(args, capture_output=True, check=True, text=True)
-        if proc.stdout:
-            log.info(f'\n\n{proc.stdout}')
-            return [v.strip().split('var.')[1].split(':')[0] for v in proc.stdout.split('\\n') if v.startswith('var.')]
-        return DEFAULT_PKR_VARS
-    except subprocess.CalledProcessError:
-        return DEFAULT_PKR_VARS
+# variable names declared in hcl files keyed by the hash of the file content
+_declared = {}
+_declared_lock = threading.Lock()
 
 
-def save_vars_file(image):
-    '''Saves properties from image.yaml to a packer auto variables file'''
-    pkr_vars = get_vars(image)
+def _scan_vars(content):
+    '''Returns the names of the top level variable blocks in the content of an hcl file'''
+    names = []
+    depth = 0
+
+    for match in HCL_TOKENS.finditer(content):
+        token = match.group()
+        if match['quoted'] or match['name']:
+            if depth == 0:
+                names.append(match['quoted'] or match['name'])
+            depth += 1
+        elif token == '{':
+            depth += 1
+        elif token == '}':
+            depth -= 1
+
+    return names
+
+
+def get_vars(image) -> list:
+    '''Gets the available packer variables from the variable blocks in the image's *.pkr.hcl files'''
+    pkr_vars = []
+
+    for path in sorted(Path(image['path']).glob('*.pkr.hcl')):
+        with open(path, 'rb') as f:
+            content = f.read()
+
+        key = hashlib.sha256(content).hexdigest()
+
+        with _declared_lock:
+            names = _declared.get(key)
+
+        if names is None:
+            names = _scan_vars(content.decode('utf-8'))
+            with _declared_lock:
+                _declared[key] = names
+
+        pkr_vars.extend(n for n in names if n not in pkr_vars)
+
+    if not pkr_vars:
+        log.warning(f'No packer variables found in the *.pkr.hcl files for {image["name"]}')
+
+    return pkr_vars
+
+
+def required_plugins(image) -> list:
+    '''Gets the name, source, and exact version (or None for other constraints) of the plugins in the image's required_plugins blocks'''
+    plugins = []
+
+    for path in sorted(Path(image['path']).glob('*.pkr.hcl')):
+        with open(path, 'r') as f:
+            content = f.read()
+
+        for block in REQUIRED_PLUGINS.finditer(content):
+            for name, body in REQUIRED_PLUGIN.findall(block[1]):
+                properties = dict(PLUGIN_PROPERTY.findall(body))
+                version = EXACT_VERSION.fullmatch(properties.get('version', ''))
+                plugins.append({
+                    'name': name,
+                    'source': properties.get('source', ''),
+                    'version': version[1] if version else None
+                })
+
+    return plugins
+
+
+def _plugin_installed(plugin) -> bool:
+    if not plugin['version'] or not plugin['source']:
+        return False
+    # packer names plugin binaries packer-plugin-<last part of the source>_v<version>_<api version>_<os>_<arch>
+    binary = f'packer-plugin-{plugin["source"].split("/")[-1]}_v{plugin["version"]}_'
+    return any(not p.name.endswith('_SHA256SUM') for p in plugin_dir.glob(f'**/{binary}*'))
+
+
+def _plugins_installed(plugins) -> bool:
+    '''Returns True if the exact versions of all the plugins are in the plugin cache'''
+    return all(_plugin_installed(p) for p in plugins)
+
+
+def _publish_plugins(staging):
+    '''Moves the plugins installed in the staging directory into the plugin cache'''
+    # checksum files go first, so a plugin binary is never visible in the cache without its checksum
+    files = sorted((p for p in staging.rglob('*') if p.is_file()), key=lambda p: not p.name.endswith('_SHA256SUM'))
+
+    for path in files:
+        locks.replace(path, plugin_dir / path.relative_to(staging))  # concurrent builds never see a partial plugin
+
+
+def _env():
+    '''Gets the environment for packer commands, pointing packer at the plugin cache if it is used'''
+    if not plugin_cache:
+        return None
+    return dict(os.environ, PACKER_PLUGIN_PATH=f'{plugin_dir}')
+
+
+class _Progress:
+    '''Parses packer -machine-readable output line by line into build, provisioner, restart, and artifact events'''
+
+    def __init__(self, image):
+        self.image = image
+        self.start = time.monotonic()
+        self.events = []
+        self.provisioners = []
+        self.artifacts = {}
+        self.build = None
+        self.provisioner = None
+
+    def _emit(self, event, **kwargs):
+        event = dict({'event': event, 'time': round(time.monotonic() - self.start, 3)}, **kwargs)
+        self.events.append(event)
+        log.info(f'[{self.image["name"]}] {" ".join(f"{k}={v}" for k, v in event.items())}')
+        return event
+
+    def _end_provisioner(self):
+        if self.provisioner:
+            self.provisioner['end'] = round(time.monotonic() - self.start, 3)
+            self.provisioner['duration'] = round(self.provisioner['end'] - self.provisioner['start'], 3)
+            self._emit('provisioner-end', build=self.build, provisioner=self.provisioner['name'], duration=self.provisioner['duration'])
+            self.provisioner = None
+
+    def _message(self, target, message):
+        if target and self.build is None:
+            self.build = target
+            self._emit('build-start', build=target)
+
+        if not message.startswith('==>'):
+            return  # output of a provisioner or builder step
+
+        message = message.split(': ', 1)[-1].strip()
+
+        for pattern, name in PROVISIONER_STARTS:
+            match = pattern.search(message)
+            if match:
+                self._end_provisioner()
+                self.provisioner = {'name': name or match[1], 'start': round(time.monotonic() - self.start, 3)}
+                self.provisioners.append(self.provisioner)
+                self._emit('provisioner-start', build=self.build, provisioner=self.provisioner['name'])
+                break
+        else:
+            if any(p.search(message) for p in PROVISIONING_ENDS):
+                self._end_provisioner()
+
+        if RESTART.search(message):
+            self._emit('restart', build=self.build, provisioner=self.provisioner['name'] if self.provisioner else None)
+
+    def feed(self, line):
+        '''Parses a line of machine-readable output, returns the human readable message or None'''
+        # timestamp,target,type,data... with commas in the data escaped
+        fields = [f.replace('%!(PACKER_COMMA)', ',') for f in line.rstrip('\r\n').split(',')]
+
+        if len(fields) < 3:
+            return line.rstrip('\r\n')  # not machine-readable (ex. a plugin writing directly to stdout)
+
+        _, target, kind, data = fields[0], fields[1], fields[2], fields[3:]
+
+        if kind == 'ui' and len(data) >= 2:
+            message = data[1].replace('\\n', '\n').replace('\\r', '\r')
+            if data[0] == 'error':
+                self._emit('error', build=self.build, message=message.strip())
+            for line in message.splitlines():
+                self._message(target, line)
+            return message
+
+        if kind == 'artifact' and len(data) >= 2:
+            artifact = self.artifacts.setdefault(data[0], {})
+            if data[1] == 'end':
+                self._end_provisioner()
+                self._emit('artifact', build=target, **{k: v for k, v in artifact.items() if k in ['id', 'string']})
+            elif len(data) >= 3:
+                artifact[data[1]] = data[2]
+
+        return None
+
+    def finish(self, returncode) -> dict:
+        '''Closes the open provisioner and returns the timing profile of the build'''
+        self._end_provisioner()
+        self._emit('build-end', build=self.build, returncode=returncode)
+        return {
+            'image': self.image['name'],
+            'version': self.image.get('version'),
+            'returncode': returncode,
+            'duration': self.events[-1]['time'],
+            'provisioners': self.provisioners,
+            'restarts': len([e for e in self.events if e['event'] == 'restart']),
+            'artifacts': list(self.artifacts.values()),
+            'events': self.events
+        }
+
+
+def save_profile(image, profile):
+    '''Saves the timing profile of a build to the storage volume next to the log file'''
+    if in_builder and not os.path.isdir(storage):
+        return None
+
+    storage.mkdir(parents=True, exist_ok=True)
+    path = storage / f'profile_{loggers.timestamp}_{image["name"]}.json'
+
+    with open(path, 'w') as f:
+        json.dump(profile, f, ensure_ascii=False, indent=4)
+
+    log.info(f'Saved packer build profile for {image["name"]} to {path}')
+
+    slowest = sorted(profile['provisioners'], key=lambda p: p.get('duration', 0), reverse=True)[:5]
+    for p in slowest:
+        log.info(f'  {p.get("duration", 0):>10.1f}s {p["name"]}')
+
+    return path
+
+
+def _auto_vars(image, pkr_vars):
     auto_vars = {}
 
     for v in pkr_vars:
         if v in image and image[v]:
             auto_vars[v] = image[v]
 
+    return auto_vars
+
+
+# ----------------
+# async functions
+# ----------------
+
+async def save_vars_file_async(image, output=None):
+    '''Saves properties from image.yaml to a packer auto variables file'''
+    pkr_vars = get_vars(image)
+    auto_vars = _auto_vars(image, pkr_vars)
+
     log.info(f'Saving {image["name"]} packer auto variables:')
     for line in json.dumps(auto_vars, indent=4).splitlines():
-        log.info(line)
+        if output:  # concurrent builds keep their output apart
+            output(line)
+        else:
+            log.info(line)
 
     with open(Path(image['path']) / AUTO_VARS_FILE, 'w') as f:
         json.dump(auto_vars, f, ensure_ascii=False, indent=4, sort_keys=True)
 
 
-def save_vars_files(images):
+async def save_vars_files_async(images):
     '''Saves properties from each image.yaml to packer auto variables files'''
-    for image in images:
-        save_vars_file(image)
+    await asyncio.gather(*[save_vars_file_async(i) for i in images])
 
 
-def init(image):
-    '''Executes the packer init command on an image'''
+async def _init_async(image, plugin_path=None, output=None):
     log.info(f'Executing packer init for {image["name"]}')
     args = _parse_command(['init', image['path']])
+    env = dict(os.environ, PACKER_PLUGIN_PATH=f'{plugin_path}') if plugin_path else None
     log.info(f'Running packer command: {" ".join(args)}')
-    proc = subprocess.run(args, stdout=sys.stdout, stderr=sys.stderr, check=True, text=True)
+
+    if output:  # concurrent builds keep their output apart
+        proc = await asyncio.create_subprocess_exec(*args, env=env, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT, limit=MAX_LINE)
+        async for line in _readlines(proc.stdout):
+            output(line.rstrip('\r\n'))
+    else:
+        proc = await asyncio.create_subprocess_exec(*args, env=env)  # output goes straight to this process' stdout/stderr
+
+    await proc.wait()
     log.info(f'Done executing packer init for {image["name"]}')
+    log.info(f'[packer init for {image["name"]} exited with {proc.returncode}]')
     return proc.returncode
 
 
-def build(image):
-    '''Executes the packer build command on an image'''
+async def init_async(image, output=None):
+    '''Executes the packer init command on an image, skipping it if the required plugins are in the plugin cache'''
+    if not plugin_cache:
+        return await _init_async(image, output=output)
+
+    plugins = required_plugins(image)
+
+    if _plugins_installed(plugins):
+        log.info(f'Skipping packer init for {image["name"]}, required plugins are in the plugin cache {plugin_dir}')
+        return 0
+
+    async with locks.FileLock(plugin_dir.parent / f'{plugin_dir.name}.lock'):
+        if _plugins_installed(plugins):  # installed by another build while waiting for the lock
+            log.info(f'Skipping packer init for {image["name"]}, required plugins were added to the plugin cache {plugin_dir}')
+            return 0
+
+        # install into a staging directory next to the cache, then move the plugins into the cache
+        staging = Path(tempfile.mkdtemp(prefix=f'.{plugin_dir.name}.', dir=plugin_dir.parent))
+        try:
+            returncode = await _init_async(image, staging, output)
+            if returncode == 0:
+                _publish_plugins(staging)
+        finally:
+            shutil.rmtree(staging, ignore_errors=True)
+
+    return returncode
+
+
+async def _readlines(stream):
+    '''Yields the lines of a stream, truncating lines longer than MAX_LINE'''
+    while True:
+        try:
+            line = await stream.readuntil(b'\n')
+        except asyncio.IncompleteReadError as e:  # end of stream
+            if e.partial:
+                yield e.partial.decode(errors='replace')
+            return
+        except asyncio.LimitOverrunError as e:  # line is longer than the limit, keep the start and skip the rest
+            line = await stream.readexactly(e.consumed)
+            while True:
+                try:
+                    await stream.readuntil(b'\n')
+                    break
+                except asyncio.LimitOverrunError as e:
+                    await stream.readexactly(e.consumed)
+                except asyncio.IncompleteReadError:
+                    break
+        yield line.decode(errors='replace')
+
+
+async def build_async(image, on_event=None, output=None):
+    '''Executes the packer build command on an image, streaming its progress events and saving a timing profile'''
     log.info(f'Executing packer build for {image["name"]}')
-    args = _parse_command(['build', '-force', image['path']])
-    if in_builder:
-        args.insert(2, '-color=false')
+    args = _parse_command(['build', '-force', '-machine-readable', image['path']])
     log.info(f'Running packer command: {" ".join(args)}')
-    proc = subprocess.run(args, stdout=sys.stdout, stderr=sys.stderr, check=True, text=True)
+    proc = await asyncio.create_subprocess_exec(*args, env=_env(), stdout=asyncio.subprocess.PIPE, limit=MAX_LINE)
+
+    progress = _Progress(image)
+    seen = 0
+
+    async for line in _readlines(proc.stdout):
+        message = progress.feed(line)
+        if message is not None and output:  # concurrent builds keep their output apart
+            output(message)
+        elif message is not None:
+            print(message, flush=True)  # keep the human readable output in the container logs
+        if on_event:
+            for event in progress.events[seen:]:
+                on_event(event)
+        seen = len(progress.events)
+
+    await proc.wait()
+
+    profile = progress.finish(proc.returncode)
+    if on_event:
+        on_event(profile['events'][-1])
+    save_profile(image, profile)
+
     log.info(f'Done executing packer build for {image["name"]}')
+    log.info(f'[packer build for {image["name"]} exited with {proc.returncode}]')
     return proc.returncode
 
 
-def execute(image):
+async def execute_async(image, on_event=None, output=None):
     '''Executes the packer init and build commands on an image'''
-    i = init(image)
-    return build(image) if i == 0 else i
+    i = await init_async(image, output)
+    return await build_async(image, on_event, output) if i == 0 else i
 
 
 # ----------------
-# async functions
+# sync functions
 # ----------------
 
-async def get_vars_async(image):
-    '''Gets the available packer variables from the variable.pkr.hcl file'''
-    try:
-        args = _parse_command(['inspect', '-machine-readable', image['path']])
-        proc = await asyncio.create_subprocess_exec(*args, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
-        stdout, stderr = await proc.communicate()
-        if stdout:
-            log.info(f'\n\n{stdout}')
-            return [v.strip().split('var.')[1].split(':')[0] for v in stdout.decode().split('\\n') if v.startswith('var.')]
-        return DEFAULT_PKR_VARS
-    except subprocess.CalledProcessError:
-        return DEFAULT_PKR_VARS
-
-
-async def save_vars_file_async(image):
-    '''Saves properties from each image.yaml to packer auto variables files'''
-    pkr_vars = await get_vars_async(image)
-    auto_vars = {}
 
-    for v in pkr_vars:
-        if v in image and image[v]:
-            auto_vars[v] = image[v]
+def save_vars_file(image, output=None):
+    '''Saves properties from image.yaml to a packer auto variables file'''
+    return asyncio.run(save_vars_file_async(image, output))
 
-    log.info(f'Saving {image["name"]} packer auto variables:')
-    for line in json.dumps(auto_vars, indent=4).splitlines():
-        log.info(line)
 
-    with open(Path(image['path']) / AUTO_VARS_FILE, 'w') as f:
-        json.dump(auto_vars, f, ensure_ascii=False, indent=4, sort_keys=True)
+def save_vars_files(images):
+    '''Saves properties from each image.yaml to packer auto variables files'''
+    return asyncio.run(save_vars_files_async(images))
 
 
-async def init_async(image):
+def init(image, output=None):
     '''Executes the packer init command on an image'''
-    log.info(f'Executing packer init for {image["name"]}')
-    args = _parse_command(['init', image['path']])
-    log.info(f'Running packer command: {" ".join(args)}')
-    proc = await asyncio.create_subprocess_exec(*args)
-    stdout, stderr = await proc.communicate()
-    # log.info(f'\n\n{stdout}')
-    log.info(f'Done executing packer init for {image["name"]}')
-    log.info(f'[packer init for {image["name"]} exited with {proc.returncode}]')
-    return proc.returncode
+    return asyncio.run(init_async(image, output))
 
 
-async def build_async(image):
-    '''Executes the packer build command on an image'''
-    log.info(f'Executing packer build for {image["name"]}')
-    args = _parse_command(['build', '-force', image['path']])
-    if in_builder:
-        args.insert(2, '-color=false')
-    log.info(f'Running packer command: {" ".join(args)}')
-    proc = await asyncio.create_subprocess_exec(*args)
-    stdout, stderr = await proc.communicate()
-    # log.info(f'\n\n{stdout}')
-    log.info(f'Done executing packer build for {image["name"]}')
-    log.info(f'[packer build for {image["name"]} exited with {proc.returncode}]')
-    return proc.returncode
+def build(image, on_event=None, output=None):
+    '''Executes the packer build command on an image, streaming its progress events and saving a timing profile'''
+    return asyncio.run(build_async(image, on_event, output))
 
 
-async def execute_async(image):
+def execute(image, on_event=None, output=None):
     '''Executes the packer init and build commands on an image'''
-    i = await init_async(image)
-    return await build_async(image) if i == 0 else i
+    return asyncio.run(execute_async(image, on_event, output))
@@ -0,0 +1,168 @@
+# ------------------------------------
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+# ------------------------------------
+
+import asyncio
+import json
+import re
+from contextlib import asynccontextmanager
+from pathlib import Path
+
+import azure as az
+import image as img
+import loggers
+
+# packer uses this vm size when the image's template doesn't set vm_size
+DEFAULT_VM_SIZE = 'Standard_D8s_v3'
+
+# cpu requested by the builder container, must match templates/builder.bicep
+BUILDER_CPU = 1
+
+# usage names of the regional vCPU quota and the container instance quotas
+REGIONAL_CORES = 'cores'
+CONTAINER_GROUPS = 'ContainerGroups'
+CONTAINER_CORES = 'StandardCores'
+
+VM_SIZE = re.compile(r'^\s*vm_size\s*=\s*"([^"]+)"', re.MULTILINE)
+
+# Standard_D8s_v3 -> family D, 8 vCPUs, features s, version 3
+VM_SIZE_PARTS = re.compile(r'^Standard_([A-Z]+)(\d+)(?:-\d+)?([a-z]*)(?:_v(\d+))?$', re.IGNORECASE)
+
+log = loggers.getLogger(__name__)
+
+
+class QuotaError(Exception):
+    '''Raised when an image's build can't be admitted, so only that image's build fails'''
+
+
+def vm_size(image) -> str:
+    '''Gets the size of the vm packer creates for an image from the vm_size in its packer template'''
+    for path in sorted(Path(image['path']).glob('*.pkr.hcl')):
+        with open(path, 'r') as f:
+            match = VM_SIZE.search(f.read())
+        if match:
+            return match.group(1)
+    return DEFAULT_VM_SIZE
+
+
+def _vm_family(size):
+    '''Gets the quota family (ex. standardDSv3Family) and number of vCPUs of a vm size (ex. Standard_D8s_v3)'''
+    match = VM_SIZE_PARTS.match(size)
+    if not match:
+        raise QuotaError(f'Could not determine the vCPUs of vm size {size}')
+
+    family, cores, features, version = match.groups()
+    return f'standard{family.upper()}{features.upper()}{f"v{version}" if version else ""}Family', int(cores)
+
+
+def footprint(image) -> dict:
+    '''Estimates the quota an image's build uses while it runs: its packer vm and builder container group'''
+    family, cores = _vm_family(vm_size(image))
+    return {
+        REGIONAL_CORES: cores,
+        family: cores,
+        CONTAINER_GROUPS: 1,
+        CONTAINER_CORES: BUILDER_CPU
+    }
+
+
+def _normalize(usages) -> dict:
+    '''Converts usages as returned by the azure cli (or already normalized) to {name: {'current': n, 'limit': n}}'''
+    if isinstance(usages, dict):
+        return {name: {'current': int(u.get('current', 0)), 'limit': int(u['limit'])} for name, u in usages.items()}
+
+    return {u['name']['value']: {'current': int(u.get('currentValue', 0)), 'limit': int(u['limit'])} for u in usages}
+
+
+async def azure_source_async(location, subscription) -> dict:
+    '''Gets the current quota usage and limits in a location from azure'''
+    log.info(f'Getting quota usage for subscription {subscription} in {location}')
+    return _normalize(await az.get_usage_async(location, subscription))
+
+
+def file_source(path):
+    '''Returns a quota source that reads the usage and limits from a json file keyed by location, used for testing offline'''
+    with open(path, 'r') as f:
+        data = {k.lower(): v for k, v in json.load(f).items()}
+
+    async def _file_source_async(location, subscription) -> dict:
+        if location.lower() not in data:
+            raise QuotaError(f'No quota usage for location {location} in {path}')
+        return _normalize(data[location.lower()])
+
+    return _file_source_async
+
+
+class Admission:
+    '''Admits builds only while the quotas in their location have room for them, queueing the rest until earlier builds finish'''
+
+    def __init__(self, source=None):
+        self.source = source or azure_source_async
+        self._usage = {}
+        self._in_use = {}
+        self._changed = asyncio.Condition()
+
+    async def _available(self, key) -> dict:
+        '''Gets the unused quota in a (location, subscription) before any builds are admitted, it is only queried once'''
+        if key not in self._usage:
+            self._usage[key] = asyncio.ensure_future(self.source(*key))
+        usage = await asyncio.shield(self._usage[key])
+        return {name: u['limit'] - u['current'] for name, u in usage.items()}
+
+    async def _headroom(self, key) -> dict:
+        '''Gets the remaining quota in a (location, subscription) after the builds admitted so far'''
+        in_use = self._in_use.setdefault(key, {})
+        return {name: available - in_use.get(name, 0) for name, available in (await self._available(key)).items()}
+
+    async def check(self, image, location):
+        '''Raises a QuotaError if a build could never fit in the quotas of its location, even with nothing else running'''
+        available = await self._available((location, image['subscription']))
+
+        for name, amount in footprint(image).items():
+            if name in available and amount > available[name]:
+                raise QuotaError(f'{image["name"]} needs {amount} {name} but only {available[name]} are available in {location}')
+
+    @asynccontextmanager
+    async def admit(self, image):
+        '''Waits until there is quota for the image's build, and releases it when the context exits'''
+        location = await img.get_location_async(image)
+
+        if not location:
+            log.warning(f'Could not determine the location {image["name"]} is built in, building it without quota admission')
+            yield
+            return
+
+        key = (location, image['subscription'])
+        needs = footprint(image)
+
+        await self.check(image, location)
+
+        async with self._changed:
+            logged = False
+            while not _fits(needs, await self._headroom(key)):
+                if not logged:
+                    log.info(f'Waiting for quota in {location} to build {image["name"]} ({_format(needs)})')
+                    logged = True
+                await self._changed.wait()
+
+            for name, amount in needs.items():
+                self._in_use[key][name] = self._in_use[key].get(name, 0) + amount
+
+        log.info(f'Admitted {image["name"]} in {location} ({_format(needs)})')
+
+        try:
+            yield
+        finally:
+            async with self._changed:
+                for name, amount in needs.items():
+                    self._in_use[key][name] -= amount
+                self._changed.notify_all()
+
+
+def _fits(needs, headroom) -> bool:
+    return all(amount <= headroom[name] for name, amount in needs.items() if name in headroom)
+
+
+def _format(needs) -> str:
+    return ', '.join(f'{name}: {amount}' for name, amount in needs.items())
@@ -3,6 +3,32 @@
 # Licensed under the MIT License.
 # ------------------------------------
 
+import hashlib
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+
+import locks
+import loggers
+
+# a mirror is updated by one container at a time, the others wait for it
+MIRROR_LOCK_TIMEOUT = 1800
+
+FULL_SHA = re.compile(r'^[0-9a-f]{40}$', re.IGNORECASE)
+CREDENTIALS = re.compile(r'(?<=://)[^/@]+@')
+
+log = loggers.getLogger(__name__)
+
+
+def error_exit(message):
+    log.error(message)
+    sys.exit(message)
+
+
 def _is_github(url) -> bool:
     return 'github.com' in url.lower()
 
@@ -107,6 +133,92 @@ def parse_url(url) -> dict:
     raise ValueError(f'{url} is not a valid repository url')
 
 
+def _redact(text) -> str:
+    '''Removes the credentials (ex. a PAT token) from the urls in a string'''
+    return CREDENTIALS.sub('', text)
+
+
+def _git(args, cwd=None) -> str:
+    '''Runs a git command and returns its output, exiting if it fails'''
+    log.info(f'Running git command: git {_redact(" ".join(args))}')
+    proc = subprocess.run(['git'] + args, cwd=cwd, capture_output=True, text=True)
+    if proc.returncode != 0:
+        error_exit(f'git {args[0]} failed: {_redact(proc.stderr.strip())}')
+    return proc.stdout.strip()
+
+
+def _has_commit(mirror, revision) -> bool:
+    proc = subprocess.run(['git', 'cat-file', '-e', f'{revision}^{{commit}}'], cwd=mirror, capture_output=True)
+    return proc.returncode == 0
+
+
+def mirror_name(url) -> str:
+    '''Gets the directory name of a repository's mirror, local repositories (used for testing) are named by their path'''
+    try:
+        repo = parse_url(url)
+        name = '_'.join(repo[k] for k in ['provider', 'org', 'project', 'repo'] if k in repo)
+    except ValueError:
+        name = Path(url.rstrip('/')).stem
+    return f'{name}.{hashlib.sha256(_redact(url).lower().encode()).hexdigest()[:8]}.git'
+
+
+def update_mirror(url, mirror_root, revision=None) -> tuple:
+    '''Creates or incrementally updates the bare mirror of a repository and returns its path and the commit of the revision'''
+    mirror_root = Path(mirror_root)
+    mirror = mirror_root / mirror_name(url)
+    mirror_root.mkdir(parents=True, exist_ok=True)
+
+    with locks.FileLock(mirror_root / f'{mirror.name}.lock', timeout=MIRROR_LOCK_TIMEOUT):
+        if not mirror.is_dir():
+            log.info(f'Creating mirror of {_redact(url)} in {mirror}')
+            # clone next to the mirror and move it into place, so an interrupted clone never looks like a mirror
+            staging = Path(tempfile.mkdtemp(prefix=f'.{mirror.name}.', dir=mirror_root))
+            try:
+                _git(['clone', '--mirror', '--quiet', url, str(staging)])
+                # never store the credentials on the share, they are passed to every fetch instead
+                _git(['remote', 'set-url', 'origin', _redact(url)], cwd=staging)
+                # checkouts share the mirror's objects, so they must never be garbage collected
+                _git(['config', 'gc.auto', '0'], cwd=staging)
+                os.replace(staging, mirror)
+            finally:
+                shutil.rmtree(staging, ignore_errors=True)
+
+        elif revision and FULL_SHA.match(revision) and _has_commit(mirror, revision):
+            log.info(f'Mirror {mirror} already has commit {revision}, skipping fetch')
+
+        else:
+            log.info(f'Fetching changes for mirror {mirror}')
+            _git(['fetch', '--quiet', '--prune', url, '+refs/heads/*:refs/heads/*', '+refs/tags/*:refs/tags/*'], cwd=mirror)
+
+        commit = _git(['rev-parse', '--verify', f'{revision or "HEAD"}^{{commit}}'], cwd=mirror)
+
+    return mirror, commit
+
+
+def checkout(mirror, commit, dest, paths) -> Path:
+    '''Checks out only the paths (directories, plus all files in the root and their parents) at a commit from a mirror'''
+    dest = Path(dest)
+
+    if dest.is_dir() and any(dest.iterdir()):
+        error_exit(f'Can not check out repository to {dest} because it is not empty')
+
+    # a shared clone reads the objects from the mirror instead of copying them
+    _git(['clone', '--shared', '--no-checkout', '--quiet', str(mirror), str(dest)])
+    _git(['sparse-checkout', 'init', '--cone'], cwd=dest)
+    _git(['sparse-checkout', 'set'] + [p.strip('/') for p in paths], cwd=dest)
+    _git(['checkout', '--quiet', '--detach', commit], cwd=dest)
+
+    return dest
+
+
+def materialize(url, dest, paths, mirror_root, revision=None) -> str:
+    '''Checks out the paths of a repository at a revision using a mirror in mirror_root, returns the commit'''
+    mirror, commit = update_mirror(url, mirror_root, revision)
+    log.info(f'Checking out {", ".join(paths)} at {commit} to {dest}')
+    checkout(mirror, commit, dest, paths)
+    return commit
+
+
 if __name__ == '__main__':
 
     import json
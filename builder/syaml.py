@@ -3,25 +3,44 @@
 # Licensed under the MIT License.
 # ------------------------------------
 
+import copy
 import os
 import sys
+import threading
 from pathlib import Path
 
 import loggers
 
+# escape sequences supported in double quoted strings
+ESCAPES = {'"': '"', '\\': '\\', '/': '/', 'n': '\n', 't': '\t', 'r': '\r', '0': '\0'}
+
+# first characters of values that aren't plain scalars: quoted strings, inline lists and maps, and block scalars
+NOT_PLAIN = '"\'[{|>'
+
 log = loggers.getLogger(__name__)
 
+# parsed yaml files keyed by path, each entry holds the (mtime, size) it was parsed at
+_parsed = {}
+_parsed_lock = threading.Lock()
+
 
 def error_exit(message):
     log.error(message)
     sys.exit(message)
 
 
-def get_file(dir, file, required=True):
+def _error(errors, message, path=None, line=None, column=None):
+    '''Exits with the message, or if an errors list is provided, adds the error to it so all errors can be reported at once'''
+    if errors is None:
+        error_exit(message)
+    errors.append({'file': f'{path}' if path else None, 'line': line, 'column': column, 'message': message.rstrip()})
+
+
+def get_file(dir, file, required=True, errors=None):
     '''Get the path to a yaml or yml file in a directory'''
     if not os.path.isdir(dir):
         if required:
-            error_exit(f'Directory for yaml/yml {file} not found at {dir}')
+            _error(errors, f'Directory for yaml/yml {file} not found at {dir}', dir)
         return None
 
     yaml = os.path.isfile(os.path.join(dir, f'{file}.yaml'))
@@ -29,11 +48,11 @@ def get_file(dir, file, required=True):
 
     if not yaml and not yml:
         if required:
-            error_exit(f'File {file}.yaml or {file}.yml not found in {dir}')
+            _error(errors, f'File {file}.yaml or {file}.yml not found in {dir}', dir)
         return None
 
     if yaml and yml:
-        error_exit(f'Found both {file}.yaml and {file}.yml in {dir} of repository. only one {file} yaml file allowed')
+        _error(errors, f'Found both {file}.yaml and {file}.yml in {dir} of repository. only one {file} yaml file allowed', dir)
 
     dir_path = dir if isinstance(dir, Path) else Path(dir)
     file_path = dir_path / f'{file}.yaml' if yaml else dir_path / f'{file}.yml'
@@ -41,81 +60,385 @@ def get_file(dir, file, required=True):
     return file_path
 
 
-def validate(path, obj, required=None, allowed=None):
+def validate(path, obj, required=None, allowed=None, errors=None):
     '''validate the yaml object against the required and allowed keys'''
+    lines = key_lines(path) if errors is not None else {}
+    valid = True
+
     if required:
         for key in required:
             if key not in obj:
-                error_exit(f'yaml file at {path} is missing required property {key}')
-            if not obj[key]:
-                error_exit(f'yaml file at {path} is missing a value for required property {key}')
+                _error(errors, f'yaml file at {path} is missing required property {key}', path, lines.get(key))
+                valid = False
+            elif not obj[key]:
+                _error(errors, f'yaml file at {path} is missing a value for required property {key}', path, lines.get(key))
+                valid = False
 
     if allowed:
         for key in obj:
             if key not in allowed:
-                error_exit(f'yaml file at {path} contains an invalid property {key}')
+                _error(errors, f'yaml file at {path} contains an invalid property {key}', path, lines.get(key))
+                valid = False
 
-    return True
+    return valid
 
 
-def parse(path, required=None, allowed=None) -> dict:
-    '''simple yaml parser, only supports a single level of nesting and arrays that use the '-' notation'''
-    obj = {}
-    with open(path, 'r') as yaml:
-        parent_key = None
+def _cached(path, errors=None):
+    '''Returns the parsed object and key line numbers for a yaml file, only parsing it if it changed since it was last parsed'''
+    stat = os.stat(path)
+    key = os.path.realpath(path)
+    version = (stat.st_mtime_ns, stat.st_size)
+
+    with _parsed_lock:
+        cached = _parsed.get(key)
+
+    if cached and cached[0] == version:
+        return cached[1], cached[2]
+
+    count = len(errors) if errors is not None else 0
+    obj, lines = _parse(path, errors)
+
+    if errors is None or len(errors) == count:  # files with errors are parsed again, so they fail outside of lint too
+        with _parsed_lock:
+            _parsed[key] = (version, obj, lines)
+
+    return obj, lines
 
-        for line in yaml:
-            if line.strip() == '' or line.lstrip().startswith('#'):  # ignore empty lines and comments
-                continue
 
-            if line.lstrip().startswith('-'):  # array item
-                if not parent_key:
-                    error_exit(f'array item found without parent key\n{line}')
+def key_lines(path) -> dict:
+    '''Get the line numbers of the top level keys in a yaml file'''
+    return _cached(path, [])[1]
 
-                if parent_key not in obj:
-                    obj[parent_key] = []
 
-                item = line.split('-')[1].strip()
+def parse(path, required=None, allowed=None, errors=None) -> dict:
+    '''simple yaml parser, supports nested block mappings and sequences, quoted strings, inline lists and maps, and comments. all scalars are strings'''
+    obj, _ = _cached(path, errors)
 
-                if ':' in item:  # object array (ex: - name: value)
-                    s_key, s_value = [s.strip() for s in item.split(':')]
-                    # if the array is empty or the last item in the array already has the key, add a new item
-                    if len(obj[parent_key]) == 0 or s_key in obj[parent_key][-1]:
-                        obj[parent_key].append({})
+    validate(path, obj, required, allowed, errors)
 
-                    obj[parent_key][-1][s_key] = s_value
-                else:  # simple array (ex: - value)
-                    obj[parent_key].append(item)
+    # callers merge and add properties to the object, so never hand out the cached one
+    return copy.deepcopy(obj)
 
-            elif ':' in line:  # key: value || key: { ... } || key: [ ... ]
 
-                key, value = [s.strip() for s in line.split(':')]
+class _SyntaxError(Exception):
+    '''Raised by the inline value parser, column is the 0-based offset in the line'''
 
-                if line.replace(line.lstrip(), '') != '':  # key is indented (property of an object)
+    def __init__(self, column, message):
+        super().__init__(message)
+        self.column = column
 
-                    if not parent_key:
-                        error_exit(f'line appears to be a property of an object but no key found in previous lines\n{line}')
-                    if not value:
-                        error_exit(f'line appears to be a property of an object but no value found\n{line}')
 
-                    if parent_key not in obj:
-                        obj[parent_key] = {}
+def _quoted(text, pos):
+    '''Reads the quoted string starting at pos, returns the unquoted value and the position after the closing quote'''
+    quote = text[pos]
+    chars = []
+    i = pos + 1
 
-                    if isinstance(obj[parent_key], list):
-                        obj[parent_key][-1][key] = value
-                    elif isinstance(obj[parent_key], dict):
-                        obj[parent_key][key] = value
+    while i < len(text):
+        c = text[i]
+        if c == quote:
+            if quote == "'" and text.startswith("''", i):  # '' is an escaped quote in single quoted strings
+                chars.append("'")
+                i += 2
+                continue
+            return ''.join(chars), i + 1
+        if c == '\\' and quote == '"':
+            if i + 1 == len(text) or text[i + 1] not in ESCAPES:
+                raise _SyntaxError(i, 'invalid escape sequence in double quoted string')
+            chars.append(ESCAPES[text[i + 1]])
+            i += 2
+            continue
+        chars.append(c)
+        i += 1
+
+    raise _SyntaxError(pos, 'quoted string is not closed')
+
+
+def _strip_comment(text):
+    '''Removes a trailing comment, a # only starts a comment at the start of the text or after whitespace outside of quotes'''
+    if '#' not in text:
+        return text
+
+    i = 0
+    while i < len(text):
+        c = text[i]
+        if c in '"\'' and (i == 0 or text[i - 1] in ' [{,'):
+            try:
+                i = _quoted(text, i)[1]
+            except _SyntaxError:
+                return text  # reported by the parser
+            continue
+        if c == '#' and (i == 0 or text[i - 1] == ' '):
+            return text[:i].rstrip()
+        i += 1
+
+    return text
+
+
+def _split_key(text):
+    '''Splits 'key: value' into (key, value, offset of value), returns None if the text is not a key/value pair'''
+    first = text[0]
+
+    if first == '[' or first == '{':
+        return None
+
+    if first == '"' or first == "'":
+        try:
+            key, end = _quoted(text, 0)
+        except _SyntaxError:
+            return None
+        colon = len(text) - len(text[end:].lstrip(' '))
+        if not text.startswith(':', colon) or (colon + 1 < len(text) and text[colon + 1] != ' '):
+            return None
+    else:
+        # a colon only ends the key when followed by a space or the end of the line (ex. urls and C:\ paths are values)
+        colon = text.find(': ')
+        if colon == -1:
+            if text[-1] != ':':
+                return None
+            colon = len(text) - 1
+        if colon < 1:
+            return None
+        key = text[:colon].rstrip()
+
+    value = text[colon + 1:].lstrip(' ')
+    return key, value, len(text) - len(value)
+
+
+def _flow_value(text, pos, terminators):
+    '''Reads an inline list, inline map, quoted, or plain value starting at pos'''
+    while pos < len(text) and text[pos] == ' ':
+        pos += 1
+
+    if pos == len(text):
+        raise _SyntaxError(pos, 'expected a value')
+
+    c = text[pos]
+
+    if c == '[':
+        items = []
+        pos += 1
+        while True:
+            while pos < len(text) and text[pos] == ' ':
+                pos += 1
+            if text.startswith(']', pos):
+                return items, pos + 1
+            item, pos = _flow_value(text, pos, ',]')
+            items.append(item)
+            while pos < len(text) and text[pos] == ' ':
+                pos += 1
+            if text.startswith(',', pos):
+                pos += 1
+            elif not text.startswith(']', pos):
+                raise _SyntaxError(pos, 'expected , or ] in inline list')
+
+    if c == '{':
+        obj = {}
+        pos += 1
+        while True:
+            while pos < len(text) and text[pos] == ' ':
+                pos += 1
+            if text.startswith('}', pos):
+                return obj, pos + 1
+            start = pos
+            key, pos = _flow_value(text, pos, ':,}')
+            if not isinstance(key, str) or not text.startswith(':', pos):
+                raise _SyntaxError(start, 'expected key: value in inline map')
+            value, pos = _flow_value(text, pos + 1, ',}')
+            obj[key] = value
+            while pos < len(text) and text[pos] == ' ':
+                pos += 1
+            if text.startswith(',', pos):
+                pos += 1
+            elif not text.startswith('}', pos):
+                raise _SyntaxError(pos, 'expected , or } in inline map')
+
+    if c in '"\'':
+        value, pos = _quoted(text, pos)
+        while pos < len(text) and text[pos] == ' ':
+            pos += 1
+        return value, pos
+
+    end = pos
+    while end < len(text) and text[end] not in terminators:
+        end += 1
+
+    return text[pos:end].rstrip(), end
+
+
+def _parse(path, errors=None):
+    '''Parses a yaml file in a single pass over its lines, returns the object and the line numbers of its top level keys'''
+    with open(path, 'r') as f:
+        text = f.read()
+
+    def error(number, column, message):
+        _error(errors, f'yaml file at {path} line {number} column {column + 1}: {message}', path, number, column + 1)
+
+    def value(number, column, text):
+        if text[0] == '|' or text[0] == '>':
+            error(number, column, 'block scalars are not supported')
+            return None
+
+        if text[0] not in '[{"\'':
+            return text
+
+        try:
+            result, end = _flow_value(text, 0, '')
+        except _SyntaxError as e:
+            error(number, column + e.column, e)
+            return None
+
+        if end < len(text):
+            error(number, column + end, 'unexpected characters after value')
+
+        return result
+
+    obj = {}
+    lines = {}
+    stack = [(0, obj, False)]  # (indent, mapping or sequence, is a sequence) of the open blocks
+    top_indent, top, in_seq = stack[-1]
+    pending = None  # (mapping or sequence, key or index, indent) of a key or item with its value on the following lines
+
+    for number, line in enumerate(text.split('\n'), start=1):
+        content = line.lstrip(' ')
+
+        if not content:
+            continue
 
-                elif not value:  # object or array, save the key for later
-                    parent_key = key
+        first = content[0]
 
-                else:  # simple key/value pair
-                    obj[key] = value
-                    parent_key = None
+        if first == '#':
+            continue
 
+        indent = len(line) - len(content)
+
+        if content[-1] in ' \t' or first == '\t':
+            if content.isspace():
+                continue
+            if first == '\t':
+                error(number, indent, 'tabs are not allowed for indentation')
+                continue
+            content = content.rstrip()
+
+        if '#' in content:
+            content = _strip_comment(content)
+
+        if first == '-':
+            if indent == 0 and content == '---':  # document start marker
+                continue
+            item = len(content) == 1 or content[1] == ' '
+        else:
+            item = False
+
+        if pending:
+            # the block under a key is indented, or a sequence at the same indentation as the key
+            container, key, pending_indent = pending
+            pending = None
+            if indent > pending_indent or (indent == pending_indent and item and container.__class__ is dict):
+                top = container[key] = [] if item else {}
+                top_indent, in_seq = indent, item
+                stack.append((indent, top, in_seq))
+
+        while top_indent > indent or (top_indent == indent and in_seq and not item):
+            stack.pop()
+            top_indent, top, in_seq = stack[-1]
+
+        if top_indent < indent:
+            error(number, indent, 'unexpected indentation')
+            continue
+
+        # fast paths for the most common lines, key: value and - value with plain keys and values
+        if item:
+            if in_seq and len(content) > 2:
+                rest = content[2:].lstrip(' ')
+                if rest[0] not in NOT_PLAIN and rest[0] != '-':
+                    colon = rest.find(': ')
+                    if colon == -1 and rest[-1] != ':':
+                        top.append(rest)
+                        continue
+                    if colon > 0:  # - key: value starts a mapping in the sequence
+                        scalar = rest[colon + 2:].lstrip(' ')
+                        if scalar and scalar[0] not in NOT_PLAIN:
+                            top_indent, in_seq = indent + len(content) - len(rest), False
+                            top.append({rest[:colon].rstrip(): scalar})
+                            top = top[-1]
+                            stack.append((top_indent, top, in_seq))
+                            continue
+
+        elif not in_seq and first not in NOT_PLAIN:
+            key, colon, rest = content.partition(': ')
+            if not colon and content[-1] == ':':
+                key, colon = content[:-1], ':'
+
+            if key and colon:
+                rest = rest.lstrip(' ')
+                if not rest or rest[0] not in NOT_PLAIN:
+                    key = key.rstrip()
+                    if key in top:
+                        error(number, indent, f'duplicate key {key}')
+                    if top is obj:
+                        lines[key] = number
+                    if rest:
+                        top[key] = rest
+                    else:
+                        top[key] = None
+                        pending = (top, key, indent)
+                    continue
+
+        column = indent
+        split = None
+
+        # items can start a nested block on the same line (ex. - name: value), so repeat until the line is consumed
+        while True:
+            if item:
+                if top.__class__ is not list:
+                    error(number, column, 'sequence item found without a parent key')
+                    break
+
+                rest = content[1:].lstrip(' ')
+                dash = column
+                column += len(content) - len(rest)
+
+                if not rest:
+                    top.append(None)
+                    pending = (top, len(top) - 1, dash)
+                    break
+
+                item = rest[0] == '-' and (len(rest) == 1 or rest[1] == ' ')
+                split = None if item else _split_key(rest)
+
+                if item or split:
+                    top.append([] if item else {})
+                    top = top[-1]
+                    stack.append((column, top, item))
+                    content = rest
+                    continue
+
+                top.append(value(number, column, rest))
+                break
+
+            if split is None and top.__class__ is dict:
+                split = _split_key(content)
+
+            if split is None:
+                error(number, column, 'expected key: value')
+                break
+
+            key, rest, offset = split
+
+            if key in top:
+                error(number, column, f'duplicate key {key}')
+
+            if top is obj:
+                lines[key] = number
+
+            if rest:
+                top[key] = value(number, column + offset, rest)
             else:
-                error_exit(f'line does not contain a colon or is misformatted\n{line}')
+                top[key] = None
+                pending = (top, key, column)
+            break
 
-    validate(path, obj, required, allowed)
+        top_indent, top, in_seq = stack[-1]  # items may have opened nested blocks
 
-    return obj
+    return obj, lines
@@ -20,12 +20,22 @@ source "azure-arm" "vm" {
   winrm_insecure = true
   winrm_use_ssl  = true
   os_type        = "Windows" # tells packer to create a certificate for WinRM connection
-  # base image options (Azure Marketplace Images only)
-  image_publisher    = "microsoftwindowsdesktop"
-  image_offer        = "windows-ent-cpc"
-  image_sku          = "win11-21h2-ent-cpc-m365"
-  image_version      = "latest"
+  # base image options (Azure Marketplace Images, unless image.yml has a base image from the gallery)
+  image_publisher    = var.base == "" ? "microsoftwindowsdesktop" : null
+  image_offer        = var.base == "" ? "windows-ent-cpc" : null
+  image_sku          = var.base == "" ? "win11-21h2-ent-cpc-m365" : null
+  image_version      = var.base == "" ? "latest" : null
   use_azure_cli_auth = true
+  dynamic "shared_image_gallery" {
+    for_each = var.base == "" ? [] : [var.base]
+    content {
+      subscription   = var.gallery.subscription
+      resource_group = var.gallery.resourceGroup
+      gallery_name   = var.gallery.name
+      image_name     = shared_image_gallery.value
+      image_version  = var.baseVersion
+    }
+  }
   # managed image options
   managed_image_name                = var.name
   managed_image_resource_group_name = var.gallery.resourceGroup
@@ -71,9 +81,12 @@ build {
 
   # https://github.com/rgl/packer-plugin-windows-update
   provisioner "windows-update" {
+    # images with a base image start from it, so the shared setup it already contains is skipped
+    except = var.base == "" ? [] : ["azure-arm.vm"]
   }
 
   provisioner "powershell" {
+    except = var.base == "" ? [] : ["azure-arm.vm"]
     elevated_user     = build.User
     elevated_password = build.Password
     scripts = [
@@ -84,6 +97,7 @@ build {
   }
 
   provisioner "powershell" {
+    except = var.base == "" ? [] : ["azure-arm.vm"]
     elevated_user     = build.User
     elevated_password = build.Password
     inline = [
@@ -94,6 +108,7 @@ build {
   }
 
   provisioner "powershell" {
+    except = var.base == "" ? [] : ["azure-arm.vm"]
     elevated_user     = build.User
     elevated_password = build.Password
     scripts = [
@@ -103,7 +118,14 @@ build {
       "${path.root}/../../scripts/Install-Python.ps1",
       "${path.root}/../../scripts/Install-GitHubDesktop.ps1",
       "${path.root}/../../scripts/Install-VSCode.ps1",
-      "${path.root}/../../scripts/Install-AzureCLI.ps1",
+      "${path.root}/../../scripts/Install-AzureCLI.ps1"
+    ]
+  }
+
+  provisioner "powershell" {
+    elevated_user     = build.User
+    elevated_password = build.Password
+    scripts = [
       "${path.root}/../../scripts/Enable-Hyperv.ps1"
     ]
   }
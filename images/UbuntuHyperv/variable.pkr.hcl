@@ -55,6 +55,18 @@ variable "subscription" {
   description = "The subscription to use for the build"
 }
 
+variable "base" {
+  type        = string
+  default     = ""
+  description = "The image in the gallery to start the build from instead of the marketplace image"
+}
+
+variable "baseVersion" {
+  type        = string
+  default     = ""
+  description = "The version of the base image, set by the builder to its latest published version"
+}
+
 variable "version" {
   type        = string
   default     = ""
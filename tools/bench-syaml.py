@@ -0,0 +1,141 @@
+# ------------------------------------
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+# ------------------------------------
+
+import argparse
+import sys
+import tempfile
+import timeit
+from pathlib import Path
+
+toolspath = Path(__file__).resolve().parent
+repopath = toolspath.parent
+
+sys.path.insert(0, str(repopath / 'builder'))
+
+import syaml  # noqa: E402 pylint: disable=wrong-import-position
+
+
+def legacy_parse(path) -> dict:
+    '''the line based parser syaml used before the tokenizer, kept to compare output and speed'''
+    obj = {}
+    with open(path, 'r') as yaml:
+        parent_key = None
+
+        for line in yaml:
+            if line.strip() == '' or line.lstrip().startswith('#'):  # ignore empty lines and comments
+                continue
+
+            if line.lstrip().startswith('-'):  # array item
+                if not parent_key:
+                    raise ValueError(f'array item found without parent key\n{line}')
+
+                if parent_key not in obj:
+                    obj[parent_key] = []
+
+                item = line.split('-')[1].strip()
+
+                if ':' in item:  # object array (ex: - name: value)
+                    s_key, s_value = [s.strip() for s in item.split(':')]
+                    # if the array is empty or the last item in the array already has the key, add a new item
+                    if len(obj[parent_key]) == 0 or s_key in obj[parent_key][-1]:
+                        obj[parent_key].append({})
+
+                    obj[parent_key][-1][s_key] = s_value
+                else:  # simple array (ex: - value)
+                    obj[parent_key].append(item)
+
+            elif ':' in line:  # key: value || key: { ... } || key: [ ... ]
+
+                key, value = [s.strip() for s in line.split(':')]
+
+                if line.replace(line.lstrip(), '') != '':  # key is indented (property of an object)
+
+                    if not parent_key:
+                        raise ValueError(f'line appears to be a property of an object but no key found in previous lines\n{line}')
+                    if not value:
+                        raise ValueError(f'line appears to be a property of an object but no value found\n{line}')
+
+                    if parent_key not in obj:
+                        obj[parent_key] = {}
+
+                    if isinstance(obj[parent_key], list):
+                        obj[parent_key][-1][key] = value
+                    elif isinstance(obj[parent_key], dict):
+                        obj[parent_key][key] = value
+
+                elif not value:  # object or array, save the key for later
+                    parent_key = key
+
+                else:  # simple key/value pair
+                    obj[key] = value
+                    parent_key = None
+
+            else:
+                raise ValueError(f'line does not contain a colon or is misformatted\n{line}')
+
+    return obj
+
+
+def synthetic(path, keys):
+    '''writes a yaml file with the constructs both parsers support (scalars, lists, object lists, and objects)'''
+    with open(path, 'w') as f:
+        f.write('# synthetic yaml file for benchmarking\n\n')
+        for i in range(keys):
+            kind = i % 4
+            if kind == 0:
+                f.write(f'key{i}: value {i}\n')
+            elif kind == 1:
+                f.write(f'list{i}:\n')
+                for j in range(5):
+                    f.write(f'  - item{j}\n')
+            elif kind == 2:
+                f.write(f'objects{i}:\n')
+                for j in range(3):
+                    f.write(f'  - name: object{j}\n    value: {j}\n')
+            else:
+                f.write(f'# comment {i}\nobject{i}:\n')
+                for j in range(4):
+                    f.write(f'  property{j}: value{j}\n')
+
+
+def tokenizer_parse(path) -> dict:
+    return syaml._parse(path)[0]
+
+
+parser = argparse.ArgumentParser(description='Compares the output and speed of the syaml tokenizer parser with the legacy line based parser')
+parser.add_argument('--keys', type=int, nargs='*', default=[100, 1000, 10000], help='number of top level keys in each synthetic file')
+parser.add_argument('--repeat', type=int, default=10, help='number of times to parse each file, the fastest time is reported')
+
+args = parser.parse_args()
+
+# the parsers must produce the same output for the yaml files in the repository
+repo_files = [repopath / 'gallery.yml'] + sorted((repopath / 'images').glob('**/*.yml'))
+
+for path in repo_files:
+    if legacy_parse(path) != tokenizer_parse(path):
+        raise ValueError(f'parsers produce different output for {path}')
+
+print(f'parsers produce the same output for {len(repo_files)} yaml files in the repository')
+print()
+print(f'{"keys":>8} {"lines":>8} {"legacy (ms)":>12} {"tokenizer (ms)":>15} {"ratio":>6}')
+
+with tempfile.TemporaryDirectory() as tmp:
+    for keys in args.keys:
+        path = Path(tmp) / f'synthetic{keys}.yml'
+        synthetic(path, keys)
+
+        if legacy_parse(path) != tokenizer_parse(path):
+            raise ValueError(f'parsers produce different output for synthetic file with {keys} keys')
+
+        with open(path, 'r') as f:
+            lines = len(f.readlines())
+
+        # alternate the parsers so both are measured under the same conditions (ex. other load on the machine)
+        legacy, tokenizer = float('inf'), float('inf')
+        for _ in range(args.repeat):
+            legacy = min(legacy, timeit.timeit(lambda: legacy_parse(path), number=1) * 1000)
+            tokenizer = min(tokenizer, timeit.timeit(lambda: tokenizer_parse(path), number=1) * 1000)
+
+        print(f'{keys:>8} {lines:>8} {legacy:>12.2f} {tokenizer:>15.2f} {tokenizer / legacy:>6.2f}')